@@ -1,6 +1,20 @@
+import time
+_T_INICIO_PROCESO = time.perf_counter()
+
 import os
 import json
+import string
+import argparse
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import grabacion
+import formato_cache
+import planificador
+import recarga_en_caliente
+import perfilado
+import latencias
+import freshdesk_api
 import survey_sender
 import ticket_assigner
 import google_sheets_handler
@@ -8,6 +22,38 @@ import fuera_horario
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE_PATH = os.path.join(SCRIPT_DIR, 'config.json')
+INTERVALO_CONTINUO_SIN_PLANIFICADOR_SEGUNDOS = 60
+# Pasado este tiempo sin poder actualizar la caché de agentes operativos no se asignan tickets.
+MINUTOS_LIMITE_AGENTES_OPERATIVOS_DEFAULT = 30
+# Con etapas_concurrentes, estas etapas corren antes y solas (ver _ejecutar_etapas_concurrentes).
+ETAPAS_ANTES_DE_PARALELO = ('fuera_horario',)
+
+# Actualización de cachés de Sheets en curso (en segundo plano).
+_hilo_actualizacion_caches = None
+
+# Directorio de perfiles indicado con --perfil; tiene prioridad sobre parametros_aplicacion.perfilado.
+_directorio_perfil_cli = None
+
+# Duración (en segundos) de cada fase del ciclo, en orden de ejecución.
+_tiempos_fases = [('importaciones', time.perf_counter() - _T_INICIO_PROCESO)]
+
+_t_inicio_ciclo = _T_INICIO_PROCESO
+
+def _reiniciar_tiempos_fases():
+    global _t_inicio_ciclo
+    _tiempos_fases.clear()
+    _t_inicio_ciclo = time.perf_counter()
+
+def _registrar_fase(nombre_fase, inicio):
+    _tiempos_fases.append((nombre_fase, time.perf_counter() - inicio))
+    return time.perf_counter()
+
+def _imprimir_tiempos_fases():
+    total = time.perf_counter() - _t_inicio_ciclo
+    print("Tiempos por fase:")
+    for nombre_fase, duracion in _tiempos_fases:
+        print(f"  {nombre_fase:<22} {duracion * 1000:9.1f} ms")
+    print(f"  {'total':<22} {total * 1000:9.1f} ms")
 
 def cargar_configuracion_principal(ruta_archivo):
     try:
@@ -21,56 +67,81 @@ def cargar_configuracion_principal(ruta_archivo):
         print(f"ERROR CRÍTICO: Error al decodificar '{ruta_archivo}'. Detalles: {e}")
         return None
 
-def cargar_cache_json(ruta_archivo_cache, default_value):
+def cargar_cache_json(ruta_archivo_cache, default_value, estricto=False):
+    # Con estricto=True (recarga en caliente) un archivo corrupto lanza ValueError
+    # en lugar de reemplazar silenciosamente la versión buena por el valor por defecto.
     if not os.path.exists(ruta_archivo_cache):
         print(f"Advertencia: Archivo de caché '{ruta_archivo_cache}' no encontrado. Usando valor por defecto: {default_value}")
         return default_value
     try:
-        with open(ruta_archivo_cache, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        print(f"Advertencia: Error al decodificar archivo de caché '{ruta_archivo_cache}'. Usando valor por defecto.")
+        return formato_cache.leer_cache(ruta_archivo_cache)
+    except formato_cache.CacheInvalida as e:
+        if estricto:
+            raise ValueError(f"Archivo de caché '{ruta_archivo_cache}' inválido: {e}")
+        print(f"Advertencia: {e} Usando valor por defecto.")
         return default_value
     except Exception as e:
         print(f"Error inesperado al cargar caché '{ruta_archivo_cache}': {e}. Usando valor por defecto.")
         return default_value
 
 
-def main():
-    print(f"--- Orquestador Principal Iniciado ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
-    
+def _cargar_configuracion_validada():
     config_principal = cargar_configuracion_principal(CONFIG_FILE_PATH)
     if not config_principal:
-        print("Finalizando orquestador debido a error de configuración principal.")
-        return
+        raise ValueError(f"ERROR CRÍTICO: No se pudo cargar '{CONFIG_FILE_PATH}'.")
 
-    fd_config = config_principal.get('freshdesk', {})
-    gs_config = config_principal.get('google_sheets', {}) 
-    archivos_estado_config = config_principal.get('archivos_estado', {})
-    params_app_config = config_principal.get('parametros_aplicacion', {}) 
+    config_secciones = {
+        "fd_config": config_principal.get('freshdesk', {}),
+        "gs_config": config_principal.get('google_sheets', {}),
+        "archivos_estado_config": config_principal.get('archivos_estado', {}),
+        "params_app_config": config_principal.get('parametros_aplicacion', {})
+    }
+    if not all([config_secciones["fd_config"], config_secciones["gs_config"], config_secciones["archivos_estado_config"]]):
+        raise ValueError("ERROR CRÍTICO: Faltan secciones clave (freshdesk, google_sheets, archivos_estado) en config.json.")
+    return config_secciones
 
-    if not all([fd_config, gs_config, archivos_estado_config]): 
-        print("ERROR CRÍTICO: Faltan secciones clave (freshdesk, google_sheets, archivos_estado) en config.json.")
-        return
-    #pausar el archivo de caché de Google Sheets
-    google_sheets_handler.ejecutar_actualizacion_caches(gs_config, archivos_estado_config)
+def _validar_plantilla(nombre_plantilla, plantilla):
+    try:
+        list(string.Formatter().parse(plantilla))
+    except ValueError as e:
+        raise ValueError(f"ERROR CRÍTICO: La plantilla {nombre_plantilla} tiene llaves mal formadas: {e}")
 
+def _armar_estado_aplicacion(config_secciones, estricto=False):
+    """
+    Carga las cachés y prepara todo lo que necesitan las etapas (plantillas
+    validadas y pre-formateadas). Lanza ValueError si algún archivo es inválido.
+    """
+    archivos_estado_config = config_secciones["archivos_estado_config"]
     ruta_mapa_agentes_cache = os.path.join(SCRIPT_DIR, archivos_estado_config.get('mapa_agentes_cache'))
     ruta_agentes_operativos_cache = os.path.join(SCRIPT_DIR, archivos_estado_config.get('agentes_operativos_cache'))
     
-    mapa_agentes_cache = cargar_cache_json(ruta_mapa_agentes_cache, default_value={})
-    agentes_operativos_cache = cargar_cache_json(ruta_agentes_operativos_cache, default_value=[])
+    mapa_agentes_cache = cargar_cache_json(ruta_mapa_agentes_cache, default_value={}, estricto=estricto)
+    agentes_operativos_cache = cargar_cache_json(ruta_agentes_operativos_cache, default_value=[], estricto=estricto)
+    horarios_agentes = None
+    if isinstance(agentes_operativos_cache, dict):
+        # Horarios compilados: los agentes operativos se calculan en cada ciclo con
+        # la hora actual. Una lista es el formato anterior (foto del momento en que
+        # se actualizó) y se usa tal cual hasta la próxima actualización desde Sheets.
+        try:
+            horarios_agentes = google_sheets_handler.horarios_desde_cache(agentes_operativos_cache)
+        except ValueError as e:
+            raise ValueError(f"ERROR CRÍTICO: La caché de agentes operativos tiene {e}.")
+        agentes_operativos_cache = horarios_agentes["ids"]
+    if not isinstance(mapa_agentes_cache, dict) or not isinstance(agentes_operativos_cache, list):
+        raise ValueError("ERROR CRÍTICO: Las cachés de agentes no tienen el formato esperado (mapa de agentes y horarios compilados).")
 
     ruta_config_global_cache = os.path.join(SCRIPT_DIR, archivos_estado_config.get('configuracion_global_cache'))
-    configuracion_global_cache = cargar_cache_json(ruta_config_global_cache, default_value={})
+    configuracion_global_cache = cargar_cache_json(ruta_config_global_cache, default_value={}, estricto=estricto)
 
     if not configuracion_global_cache:
-        print("ERROR CRÍTICO: La configuración global (mensajes, horarios) no pudo ser cargada desde la caché. ")
-        return 
+        raise ValueError("ERROR CRÍTICO: La configuración global (mensajes, horarios) no pudo ser cargada desde la caché. ")
 
     mensaje_apertura_plantilla = configuracion_global_cache.get('MENSAJE_APERTURA', "Plantilla de apertura no encontrada en Sheet.")
     mensaje_cierre_plantilla = configuracion_global_cache.get('MENSAJE_CIERRE_ENCUESTA', "Plantilla de cierre no encontrada en Sheet.")
     mensaje_fuera_horario_plantilla = configuracion_global_cache.get('MENSAJE_FUERA_HORARIO', "Plantilla de fuera de horario no encontrada en Sheet.")
+    _validar_plantilla('MENSAJE_APERTURA', mensaje_apertura_plantilla)
+    _validar_plantilla('MENSAJE_CIERRE_ENCUESTA', mensaje_cierre_plantilla)
+    _validar_plantilla('MENSAJE_FUERA_HORARIO', mensaje_fuera_horario_plantilla)
     
     horario_atencion_config = {
         "hora_inicio": configuracion_global_cache.get('HORARIO_ATENCION_INICIO'),
@@ -97,41 +168,326 @@ def main():
         print("Advertencia: Las cachés de agentes están vacías. La asignación de tickets podría no funcionar.")
     elif not agentes_operativos_cache:
          print("Advertencia: La caché de agentes operativos está vacía. La asignación de tickets no funcionará.")
-    
-    fuera_horario.ejecutar_proceso_fuera_de_horario(
-        fd_config,
-        mensaje_fuera_horario_plantilla, 
-        horario_atencion_config,      
-        archivos_estado_config,
-        params_app_config, 
-        SCRIPT_DIR
+
+    return {
+        "config": config_secciones,
+        "mapa_agentes_cache": mapa_agentes_cache,
+        "agentes_operativos_cache": agentes_operativos_cache,
+        "horarios_agentes": horarios_agentes,
+        "mensaje_apertura_plantilla": mensaje_apertura_plantilla,
+        "mensaje_cierre_plantilla": mensaje_cierre_plantilla,
+        "mensaje_fuera_horario_plantilla": mensaje_fuera_horario_plantilla,
+        "horario_atencion_config": horario_atencion_config
+    }
+
+def _cargar_estado_completo():
+    return _armar_estado_aplicacion(_cargar_configuracion_validada(), estricto=True)
+
+def _iniciar_recarga_en_caliente():
+    try:
+        archivos_estado_config = _cargar_configuracion_validada()["archivos_estado_config"]
+    except ValueError as e:
+        print(f"{e} Recarga en caliente desactivada; se leerán los archivos en cada ciclo.")
+        return
+    rutas_observadas = [CONFIG_FILE_PATH] + [
+        os.path.join(SCRIPT_DIR, archivos_estado_config[clave])
+        for clave in ('mapa_agentes_cache', 'agentes_operativos_cache', 'configuracion_global_cache')
+        if archivos_estado_config.get(clave)
+    ]
+    if not recarga_en_caliente.iniciar(rutas_observadas, _cargar_estado_completo):
+        print("Recarga en caliente desactivada; se leerán los archivos en cada ciclo.")
+
+def _ejecutar_etapa(nombre_etapa, funcion_etapa, argumentos, timeout_segundos):
+    inicio = time.perf_counter()
+    resultado = {"etapa": nombre_etapa, "estado": "ok", "procesados": 0, "inicio": time.time()}
+    with freshdesk_api.etapa(nombre_etapa, timeout_segundos) as estado_api, perfilado.perfilar(nombre_etapa):
+        try:
+            resultado["procesados"] = funcion_etapa(*argumentos) or 0
+        except freshdesk_api.TiempoEtapaAgotado as e:
+            print(f"Etapa '{nombre_etapa}' interrumpida: {e}")
+        except Exception as e:
+            print(f"ERROR no controlado en la etapa '{nombre_etapa}': {e}")
+            resultado["estado"] = "error"
+    if estado_api["tiempo_agotado"]:
+        resultado["estado"] = "tiempo agotado"
+    resultado["solicitudes_api"] = estado_api["solicitudes"]
+    resultado["lecturas_en_cache"] = estado_api["lecturas_en_cache"]
+    resultado["tickets_encontrados"] = estado_api["tickets_encontrados"]
+    resultado["busco_tickets"] = estado_api["busco_tickets"]
+    resultado["fechas_tickets"] = estado_api["fechas_tickets"]
+    resultado["cupo_api"] = estado_api["cupo"]
+    resultado["espera_cupo_api"] = estado_api["espera_cupo"]
+    resultado["duracion"] = time.perf_counter() - inicio
+    return resultado
+
+def _ejecutar_etapas_secuenciales(etapas, timeouts_etapas):
+    resultados = []
+    for i, (nombre_etapa, funcion_etapa, argumentos) in enumerate(etapas):
+        if i > 0:
+            print("\n--------------------------------------------------\n")
+        resultados.append(_ejecutar_etapa(nombre_etapa, funcion_etapa, argumentos, timeouts_etapas.get(nombre_etapa)))
+    return resultados
+
+def _ejecutar_etapas_concurrentes(etapas, timeouts_etapas):
+    # fuera_horario y asignaciones pueden tomar el mismo ticket (sin agente y
+    # pendiente), así que fuera_horario corre primero y sola; el asignador además
+    # omite los tickets que ya respondió. El resto corre en paralelo y comparte
+    # el límite de solicitudes de freshdesk_api: el tiempo del ciclo pasa a ser
+    # el de fuera_horario más el de la etapa paralela más lenta.
+    resultados = [
+        _ejecutar_etapa(nombre_etapa, funcion_etapa, argumentos, timeouts_etapas.get(nombre_etapa))
+        for nombre_etapa, funcion_etapa, argumentos in etapas if nombre_etapa in ETAPAS_ANTES_DE_PARALELO
+    ]
+    etapas_paralelas = [etapa for etapa in etapas if etapa[0] not in ETAPAS_ANTES_DE_PARALELO]
+    if not etapas_paralelas:
+        return resultados
+    print(f"Ejecutando {len(etapas_paralelas)} etapas en paralelo.")
+    with ThreadPoolExecutor(max_workers=len(etapas_paralelas), thread_name_prefix='etapa') as executor:
+        futuros = [
+            executor.submit(_ejecutar_etapa, nombre_etapa, funcion_etapa, argumentos, timeouts_etapas.get(nombre_etapa))
+            for nombre_etapa, funcion_etapa, argumentos in etapas_paralelas
+        ]
+        return resultados + [futuro.result() for futuro in futuros]
+
+def _imprimir_resultados_etapas(resultados_etapas):
+    print("\nResultado por etapa:")
+    for resultado in resultados_etapas:
+        print(f"  {resultado['etapa']:<14} {resultado['estado']:<15} procesados: {resultado['procesados']:<4} "
+              f"encontrados: {resultado['tickets_encontrados']:<4} "
+              f"solicitudes API: {resultado['solicitudes_api']:<5} en caché: {resultado['lecturas_en_cache']:<4} {resultado['duracion']:.2f} s")
+    if any(sum(resultado['cupo_api'].values()) for resultado in resultados_etapas):
+        print("Consumo del límite de API por etapa:")
+        for resultado in resultados_etapas:
+            cupo = resultado['cupo_api']
+            print(f"  {resultado['etapa']:<14} reservado: {cupo['reservado']:<5} común: {cupo['comun']:<5} "
+                  f"prestado: {cupo['prestado']:<5} espera por cupo: {resultado['espera_cupo_api']:.1f} s")
+
+def _actualizar_caches_sheets(gs_config, archivos_estado_config, formato_caches, recargar_estado):
+    with perfilado.perfilar('caches_sheets'):
+        exitosa = google_sheets_handler.ejecutar_actualizacion_caches(gs_config, archivos_estado_config, formato_caches)
+    if exitosa and recargar_estado:
+        recarga_en_caliente.recargar_ahora("actualización de cachés desde Sheets")
+    return exitosa
+
+def _iniciar_actualizacion_caches_en_segundo_plano(gs_config, archivos_estado_config, formato_caches, recargar_estado):
+    # Las etapas arrancan con las cachés que hay en disco mientras Sheets responde;
+    # la versión nueva se usa en el próximo ciclo (o al instante con recarga en caliente).
+    global _hilo_actualizacion_caches
+    if _hilo_actualizacion_caches is not None and _hilo_actualizacion_caches.is_alive():
+        print("Actualización de cachés de Sheets todavía en curso desde el ciclo anterior.")
+        return
+    _hilo_actualizacion_caches = threading.Thread(
+        target=_actualizar_caches_sheets, args=(gs_config, archivos_estado_config, formato_caches, recargar_estado),
+        name='actualizacion-caches', daemon=True
     )
-    print("\n--------------------------------------------------\n")
+    _hilo_actualizacion_caches.start()
+
+def _esperar_actualizacion_caches():
+    if _hilo_actualizacion_caches is not None and _hilo_actualizacion_caches.is_alive():
+        print("Esperando que termine la actualización de cachés de Google Sheets...")
+        _hilo_actualizacion_caches.join()
+
+def _configurar_perfilado(params_app_config):
+    config_perfilado = params_app_config.get('perfilado', {})
+    top_n = config_perfilado.get('top_n', perfilado.TOP_N_DEFAULT)
+    if _directorio_perfil_cli:
+        perfilado.activar(_directorio_perfil_cli, top_n)
+    elif config_perfilado.get('activo', False):
+        perfilado.activar(os.path.join(SCRIPT_DIR, config_perfilado.get('directorio', 'perfiles')), top_n)
+    else:
+        perfilado.desactivar()
+
+
+def main():
+    print(f"--- Orquestador Principal Iniciado ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
+    inicio_fase = time.perf_counter()
     
-    if agentes_operativos_cache: 
-        ticket_assigner.ejecutar_proceso_asignaciones(
-            fd_config,
-            mensaje_apertura_plantilla,
-            archivos_estado_config,
-            SCRIPT_DIR, 
-            mapa_agentes_cache,
-           agentes_operativos_cache 
+    estado_en_caliente = recarga_en_caliente.obtener_estado()
+    if estado_en_caliente is not None:
+        # Proceso continuo: se usa el último estado válido cargado por el observador.
+        config_secciones = estado_en_caliente["config"]
+    else:
+        try:
+            config_secciones = _cargar_configuracion_validada()
+        except ValueError as e:
+            print(e)
+            print("Finalizando orquestador debido a error de configuración principal.")
+            return
+    gs_config = config_secciones["gs_config"]
+    archivos_estado_config = config_secciones["archivos_estado_config"]
+    params_app_config = config_secciones["params_app_config"]
+    _configurar_perfilado(params_app_config)
+    inicio_fase = _registrar_fase('configuracion', inicio_fase)
+
+    # Si las cachés son recientes no se consulta Sheets (ni se importan gspread/google-auth).
+    # Si no, se actualizan en segundo plano y el ciclo sigue con las que hay en disco;
+    # solo se espera a Sheets cuando todavía no existe alguna de las cachés.
+    minutos_vigencia_caches = params_app_config.get('minutos_vigencia_caches_sheets', 0)
+    formato_caches = params_app_config.get('formato_caches', 'json')
+    antiguedades_caches = google_sheets_handler.antiguedad_caches_minutos(archivos_estado_config)
+    if google_sheets_handler.caches_vigentes(archivos_estado_config, minutos_vigencia_caches):
+        print(f"Cachés de Google Sheets actualizadas hace menos de {minutos_vigencia_caches} min. Se omite la actualización.")
+    elif None in antiguedades_caches.values() or not params_app_config.get('actualizacion_caches_en_segundo_plano', True):
+        _actualizar_caches_sheets(gs_config, archivos_estado_config, formato_caches, estado_en_caliente is not None)
+    else:
+        print(f"Usando cachés de Google Sheets de hasta {max(antiguedades_caches.values()):.0f} min de antigüedad "
+              f"mientras se actualizan en segundo plano.")
+        _iniciar_actualizacion_caches_en_segundo_plano(gs_config, archivos_estado_config, formato_caches, estado_en_caliente is not None)
+    inicio_fase = _registrar_fase('caches_sheets', inicio_fase)
+
+    if estado_en_caliente is not None:
+        estado_app = recarga_en_caliente.obtener_estado()
+    else:
+        try:
+            estado_app = _armar_estado_aplicacion(config_secciones)
+        except ValueError as e:
+            print(e)
+            return
+    inicio_fase = _registrar_fase('carga_caches', inicio_fase)
+
+    fd_config = estado_app["config"]["fd_config"]
+    archivos_estado_config = estado_app["config"]["archivos_estado_config"]
+    params_app_config = estado_app["config"]["params_app_config"]
+    mapa_agentes_cache = estado_app["mapa_agentes_cache"]
+    agentes_operativos_cache = estado_app["agentes_operativos_cache"]
+    mensaje_apertura_plantilla = estado_app["mensaje_apertura_plantilla"]
+    mensaje_cierre_plantilla = estado_app["mensaje_cierre_plantilla"]
+    mensaje_fuera_horario_plantilla = estado_app["mensaje_fuera_horario_plantilla"]
+    horario_atencion_config = estado_app["horario_atencion_config"]
+
+    if estado_app["horarios_agentes"] is not None:
+        agentes_operativos_cache = google_sheets_handler.agentes_operativos_ahora(
+            estado_app["horarios_agentes"], horario_atencion_config["timezone"]
         )
+        print(f"Agentes operativos en este momento: {len(agentes_operativos_cache)}.")
+
+    # Los horarios se evalúan en cada ciclo, pero la hoja puede haber cambiado
+    # (agentes dados de baja, turnos nuevos): una caché demasiado vieja no se usa.
+    limite_agentes_operativos = params_app_config.get('minutos_limite_agentes_operativos', MINUTOS_LIMITE_AGENTES_OPERATIVOS_DEFAULT)
+    antiguedad_agentes_operativos = google_sheets_handler.antiguedad_caches_minutos(archivos_estado_config)['agentes_operativos_cache']
+    if limite_agentes_operativos and antiguedad_agentes_operativos is not None and antiguedad_agentes_operativos > limite_agentes_operativos:
+        print(f"Advertencia: La caché de agentes operativos tiene {antiguedad_agentes_operativos:.0f} min "
+              f"(límite {limite_agentes_operativos} min). No se asignarán tickets hasta que se actualice desde Sheets.")
+        agentes_operativos_cache = []
+
+    config_planificacion = params_app_config.get('planificacion_adaptativa', {})
+    planificacion_activa = config_planificacion.get('activa', False)
+    params_fuera_horario = params_app_config
+    if planificacion_activa:
+        ruta_estado_planificador = os.path.join(SCRIPT_DIR, archivos_estado_config.get('planificador_estado', 'planificador_estado.json'))
+        estado_planificador = planificador.cargar_estado(ruta_estado_planificador)
+        # La ventana de búsqueda de fuera de horario se estira hasta la última consulta exitosa.
+        params_fuera_horario = dict(params_app_config, minutos_antiguedad_max_busqueda_fh=planificador.minutos_ventana_busqueda(
+            estado_planificador, 'fuera_horario',
+            params_app_config.get('minutos_antiguedad_max_busqueda_fh', 60), config_planificacion
+        ))
+
+    etapas = [(
+        'fuera_horario',
+        fuera_horario.ejecutar_proceso_fuera_de_horario,
+        (fd_config, mensaje_fuera_horario_plantilla, horario_atencion_config,
+         archivos_estado_config, params_fuera_horario, SCRIPT_DIR)
+    )]
+    if agentes_operativos_cache: 
+        etapas.append((
+            'asignaciones',
+            ticket_assigner.ejecutar_proceso_asignaciones,
+            (fd_config, mensaje_apertura_plantilla, archivos_estado_config,
+             SCRIPT_DIR, mapa_agentes_cache, agentes_operativos_cache, params_app_config)
+        ))
     else:
         print("Saltando proceso de asignación de tickets: no hay agentes operativos en caché.")
-    
-    print("\n--------------------------------------------------\n")
-    
-    survey_sender.ejecutar_proceso_encuestas(
-       fd_config, 
-       mensaje_cierre_plantilla,
-       archivos_estado_config,
-       params_app_config, 
-       SCRIPT_DIR, 
-       mapa_agentes_cache
-    )
+    etapas.append((
+        'encuestas',
+        survey_sender.ejecutar_proceso_encuestas,
+        (fd_config, mensaje_cierre_plantilla, archivos_estado_config,
+         params_app_config, SCRIPT_DIR, mapa_agentes_cache)
+    ))
+    nombres_etapas_candidatas = [etapa[0] for etapa in etapas]
+    if planificacion_activa:
+        etapas_pendientes = [etapa for etapa in etapas if planificador.etapa_pendiente(estado_planificador, etapa[0])]
+        for nombre_etapa in sorted({etapa[0] for etapa in etapas} - {etapa[0] for etapa in etapas_pendientes}):
+            intervalo = estado_planificador.get(nombre_etapa, {}).get('intervalo_segundos', 0)
+            print(f"Planificador: etapa '{nombre_etapa}' aún no corresponde (intervalo actual {intervalo:.0f} s).")
+        etapas = etapas_pendientes
 
+    freshdesk_api.configurar_limite(params_app_config.get('limite_solicitudes_api_por_minuto'),
+                                    params_app_config.get('reparto_limite_api'))
+    freshdesk_api.iniciar_ciclo(params_app_config.get('cache_lecturas_api', True))
+    timeouts_etapas = params_app_config.get('timeout_etapas_segundos', {})
+    if params_app_config.get('etapas_concurrentes', False):
+        resultados_etapas = _ejecutar_etapas_concurrentes(etapas, timeouts_etapas)
+    else:
+        resultados_etapas = _ejecutar_etapas_secuenciales(etapas, timeouts_etapas)
+    _registrar_fase('etapas', inicio_fase)
+
+    _imprimir_resultados_etapas(resultados_etapas)
+    ruta_latencias = os.path.join(SCRIPT_DIR, archivos_estado_config.get('latencias_tickets', latencias.ARCHIVO_LATENCIAS_DEFAULT))
+    latencias.imprimir_resumen(latencias.volcar(ruta_latencias), "Latencia de tickets en este ciclo")
+
+    segundos_hasta_proximo_ciclo = None
+    if planificacion_activa:
+        for resultado in resultados_etapas:
+            if not resultado['busco_tickets']:
+                # Sin búsqueda (fuera_horario dentro del horario, sin agentes, error
+                # en la búsqueda) no hay nada que observar: la etapa sigue pendiente.
+                print(f"Planificador: '{resultado['etapa']}' no buscó tickets en este ciclo; no se actualiza su tasa.")
+                continue
+            llegadas = planificador.contar_llegadas(estado_planificador, resultado['etapa'], resultado['fechas_tickets'])
+            intervalo = planificador.registrar_observacion(
+                estado_planificador, resultado['etapa'], llegadas,
+                resultado['estado'] == 'ok', config_planificacion, ahora=resultado['inicio']
+            )
+            tasa = estado_planificador[resultado['etapa']]['tasa_por_minuto']
+            print(f"Planificador: '{resultado['etapa']}' tasa estimada "
+                  f"{'sin datos' if tasa is None else f'{tasa:.2f} tickets/min'}, próxima consulta en {intervalo:.0f} s.")
+        planificador.guardar_estado(ruta_estado_planificador, estado_planificador)
+        segundos_hasta_proximo_ciclo = max(
+            planificador.segundos_hasta_proxima(estado_planificador, nombres_etapas_candidatas),
+            config_planificacion.get('intervalo_min_segundos', planificador.INTERVALO_MIN_SEGUNDOS_DEFAULT)
+        )
+
+    _imprimir_tiempos_fases()
     print(f"\n--- Orquestador Principal Finalizado ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---")
+    return segundos_hasta_proximo_ciclo
+
+def _parsear_argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Orquestador de automatizaciones de Freshdesk.")
+    grupo_trafico = parser.add_mutually_exclusive_group()
+    grupo_trafico.add_argument('--grabar', metavar='CASSETTE',
+                               help="Graba el tráfico con Freshdesk y Google Sheets en el cassette indicado (API key redactada).")
+    grupo_trafico.add_argument('--reproducir', metavar='CASSETTE',
+                               help="Ejecuta el ciclo sirviendo las respuestas desde el cassette indicado, sin red.")
+    parser.add_argument('--continuo', action='store_true',
+                        help="Mantiene el proceso en ejecución y repite el ciclo según el planificador adaptativo.")
+    parser.add_argument('--perfil', metavar='DIRECTORIO', nargs='?', const='perfiles',
+                        help="Perfila cada etapa y guarda .pstats y pilas colapsadas (flamegraph) en DIRECTORIO (por defecto 'perfiles').")
+    parser.add_argument('--respetar-tiempos', action='store_true',
+                        help="Con --reproducir, espera la duración original de cada respuesta grabada.")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = _parsear_argumentos()
+    if args.perfil:
+        _directorio_perfil_cli = os.path.join(SCRIPT_DIR, args.perfil)
+    if args.grabar:
+        grabacion.iniciar_grabacion(args.grabar)
+    elif args.reproducir:
+        grabacion.iniciar_reproduccion(args.reproducir, respetar_tiempos=args.respetar_tiempos)
+    try:
+        if args.continuo:
+            _iniciar_recarga_en_caliente()
+            while True:
+                segundos_espera = main()
+                if segundos_espera is None:
+                    segundos_espera = INTERVALO_CONTINUO_SIN_PLANIFICADOR_SEGUNDOS
+                print(f"Próximo ciclo en {segundos_espera:.0f} s.")
+                time.sleep(segundos_espera)
+                _reiniciar_tiempos_fases()
+        else:
+            main()
+            _esperar_actualizacion_caches()
+    except KeyboardInterrupt:
+        print("Orquestador detenido por el usuario.")
+    finally:
+        grabacion.finalizar()
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""
+Microbenchmarks del camino de CPU de cada ciclo: parseo de horarios, chequeo
+de turno y descanso, cálculo de agentes operativos, rotación de agentes y
+formateo de plantillas, sobre planillas sintéticas de 10 a 10000 agentes.
+
+Uso:
+    python benchmarks/bench_ciclo.py                          # solo muestra resultados
+    python benchmarks/bench_ciclo.py --guardar linea_base.json
+    python benchmarks/bench_ciclo.py --comparar linea_base.json [--tolerancia 0.25] [--diferencia-minima-ms 0.01]
+
+Con --comparar el proceso termina con código 1 si algún caso es más lento que
+la línea base en más de la tolerancia indicada y, además, en más de
+--diferencia-minima-ms por llamada (para que el ruido en casos de pocos
+microsegundos no cuente como regresión).
+
+Cada caso se mide con timeit: una ejecución de calentamiento, autorange() para
+elegir cuántas llamadas juntar por muestra (al menos 0.2 s) y el mejor tiempo
+por llamada entre las repeticiones.
+"""
+import os
+import sys
+import json
+import timeit
+import random
+import argparse
+import platform
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google_sheets_handler  # noqa: E402
+import ticket_assigner  # noqa: E402
+
+TAMANOS_DEFAULT = [10, 100, 1000, 10000]
+TOLERANCIA_DEFAULT = 0.25
+DIFERENCIA_MINIMA_MS_DEFAULT = 0.01
+SEMILLA = 20240601
+# Un lunes a las 23:30: cae dentro de turnos nocturnos y de descansos que cruzan la medianoche.
+INSTANTE_REFERENCIA = datetime.datetime(2024, 6, 3, 23, 30)
+
+PLANTILLA_APERTURA = ("Hola! Gracias por contactarnos.<br><br>Tu número de ticket es {ticket_id} "
+                      "y ha sido asignado a nuestro agente {agent_name}.")
+PLANTILLA_FUERA_HORARIO = ("Actualmente estamos fuera de horario. <br> Nuestro horario de atencion es de "
+                           "{HORARIO_ATENCION_INICIO} a {HORARIO_ATENCION_FIN}. Ticket {ticket_id}.")
+
+
+def _hora_aleatoria(rng):
+    return f"{rng.randint(0, 23):02d}:{rng.choice((0, 15, 30, 45)):02d}"
+
+
+def _turno_aleatorio(rng):
+    tipo = rng.random()
+    if tipo < 0.15:
+        return ''
+    if tipo < 0.25:
+        return 'off'
+    if tipo < 0.40:
+        # Turno nocturno (cruza la medianoche)
+        return f"{rng.randint(18, 23):02d}:00 a {rng.randint(0, 8):02d}:00"
+    if tipo < 0.45:
+        return f"{_hora_aleatoria(rng)}-{_hora_aleatoria(rng)}"
+    if tipo < 0.47:
+        return "9 a la tarde"  # formato inválido
+    return f"{_hora_aleatoria(rng)} a {_hora_aleatoria(rng)}"
+
+
+def generar_planilla_agentes(cantidad_agentes, semilla=SEMILLA):
+    rng = random.Random(semilla + cantidad_agentes)
+    registros = []
+    for i in range(cantidad_agentes):
+        descanso = rng.choice(('', '', '13:00', '23:30', '00:00', '12:15', 'xx:yy'))
+        fila = {
+            google_sheets_handler.COL_AGENT_ID: str(100000 + i),
+            google_sheets_handler.COL_AGENT_NAME: f"Agente {i}",
+            google_sheets_handler.COL_STATUS: rng.choice(('Activo', 'Activo', 'Activo', 'Inactivo')),
+            google_sheets_handler.COL_DESCANSO_INICIO_HORA: descanso,
+        }
+        for prefijo_dia in google_sheets_handler.DIAS_SEMANA_COLUMNAS.values():
+            fila[f"{prefijo_dia}{google_sheets_handler.COL_SUFFIX_HORARIO1}"] = _turno_aleatorio(rng)
+            fila[f"{prefijo_dia}{google_sheets_handler.COL_SUFFIX_HORARIO2}"] = _turno_aleatorio(rng)
+        registros.append(fila)
+    return registros
+
+
+def _medir(funcion, repeticiones):
+    """Mejor tiempo por llamada (segundos) entre 'repeticiones' muestras de funcion()."""
+    temporizador = timeit.Timer(funcion)
+    funcion()  # calentamiento: cachés, imports perezosos, primeras asignaciones
+    llamadas, _ = temporizador.autorange()
+    return min(temporizador.repeat(repeat=repeticiones, number=llamadas)) / llamadas
+
+
+class _SinSalida:
+    # Las funciones medidas imprimen advertencias para filas inválidas; no se quiere medir la consola.
+    def write(self, _texto):
+        pass
+
+    def flush(self):
+        pass
+
+
+def casos_de_benchmark(registros):
+    gsh = google_sheets_handler
+    prefijo_hoy = gsh.DIAS_SEMANA_COLUMNAS[INSTANTE_REFERENCIA.weekday()]
+    turnos_hoy = [
+        (str(fila.get(f"{prefijo_hoy}{gsh.COL_SUFFIX_HORARIO1}", '')), str(fila.get(f"{prefijo_hoy}{gsh.COL_SUFFIX_HORARIO2}", '')))
+        for fila in registros
+    ]
+    turnos_parseados = [(gsh._parse_horario_string(h1), gsh._parse_horario_string(h2)) for h1, h2 in turnos_hoy]
+    descansos = [str(fila.get(gsh.COL_DESCANSO_INICIO_HORA, '')) for fila in registros]
+    horarios_compilados = gsh.compilar_horarios_agentes(registros)
+    ids_operativos = [str(fila[gsh.COL_AGENT_ID]) for fila in registros]
+    mapa_agentes = horarios_compilados["mapa_agentes"]
+
+    def parse_horarios():
+        for h1, h2 in turnos_hoy:
+            gsh._parse_horario_string(h1)
+            gsh._parse_horario_string(h2)
+
+    def chequeo_turno():
+        for (h1_ini, h1_fin), (h2_ini, h2_fin) in turnos_parseados:
+            gsh._is_currently_on_shift(h1_ini, h1_fin, INSTANTE_REFERENCIA) or \
+                gsh._is_currently_on_shift(h2_ini, h2_fin, INSTANTE_REFERENCIA)
+
+    def chequeo_descanso():
+        for descanso in descansos:
+            gsh._is_on_active_break(descanso, INSTANTE_REFERENCIA)
+
+    def agentes_operativos():
+        compilado = gsh.compilar_horarios_agentes(registros)
+        gsh.agentes_disponibles_en(compilado, INSTANTE_REFERENCIA)
+
+    def consulta_disponibles():
+        gsh.agentes_disponibles_en(horarios_compilados, INSTANTE_REFERENCIA)
+
+    def rotacion():
+        # Solo la elección del agente: la lectura/escritura de ultimo_agente.txt
+        # mediría el disco, no el código.
+        ultimo_id = None
+        for _ in range(20):
+            ultimo_id = ticket_assigner._siguiente_agente_en_rotacion(ids_operativos, ultimo_id)
+
+    def plantillas():
+        for agent_id in ids_operativos[:1000]:
+            PLANTILLA_APERTURA.format(ticket_id=agent_id, agent_name=mapa_agentes.get(agent_id, "nuestro equipo"))
+        PLANTILLA_FUERA_HORARIO.format(HORARIO_ATENCION_INICIO="07:00", HORARIO_ATENCION_FIN="01:00",
+                                       ticket_id="{ticket_id}").format(ticket_id="123")
+
+    return {
+        "parse_horario_string": parse_horarios,
+        "is_currently_on_shift": chequeo_turno,
+        "is_on_active_break": chequeo_descanso,
+        "agentes_operativos_ciclo": agentes_operativos,
+        "consulta_disponibles_compilado": consulta_disponibles,
+        "rotacion_agente_x20": rotacion,
+        "formateo_plantillas": plantillas,
+    }
+
+
+def ejecutar_benchmarks(tamanos, repeticiones):
+    resultados = {}
+    salida_original = sys.stdout
+    for cantidad_agentes in tamanos:
+        registros = generar_planilla_agentes(cantidad_agentes)
+        sys.stdout = _SinSalida()
+        try:
+            casos = casos_de_benchmark(registros)
+            tiempos = {nombre: _medir(funcion, repeticiones) for nombre, funcion in casos.items()}
+        finally:
+            sys.stdout = salida_original
+        for nombre, segundos in tiempos.items():
+            resultados[f"{nombre}[{cantidad_agentes}]"] = segundos
+            print(f"  {nombre + f'[{cantidad_agentes}]':<42} {segundos * 1000:10.3f} ms")
+    return resultados
+
+
+def comparar_con_linea_base(resultados, linea_base, tolerancia, diferencia_minima_ms=DIFERENCIA_MINIMA_MS_DEFAULT):
+    regresiones = []
+    print(f"\nComparación con la línea base (tolerancia {tolerancia:.0%}, diferencia mínima {diferencia_minima_ms} ms):")
+    for caso, segundos in resultados.items():
+        base = linea_base.get(caso)
+        if base is None:
+            print(f"  {caso:<42} sin dato en la línea base")
+            continue
+        variacion = (segundos - base) / base if base > 0 else 0.0
+        diferencia_ms = (segundos - base) * 1000
+        marca = "REGRESIÓN" if variacion > tolerancia and diferencia_ms > diferencia_minima_ms else ""
+        print(f"  {caso:<42} {base * 1000:10.3f} -> {segundos * 1000:10.3f} ms ({variacion:+.1%}) {marca}")
+        if marca:
+            regresiones.append(caso)
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks del ciclo de automatización.")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=TAMANOS_DEFAULT,
+                        help="Cantidades de agentes de las planillas sintéticas.")
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--guardar', metavar='ARCHIVO_JSON', help="Guarda los resultados como línea base.")
+    parser.add_argument('--comparar', metavar='ARCHIVO_JSON', help="Compara contra una línea base guardada.")
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA_DEFAULT,
+                        help="Aumento relativo tolerado antes de considerar regresión (0.25 = 25%%).")
+    parser.add_argument('--diferencia-minima-ms', type=float, default=DIFERENCIA_MINIMA_MS_DEFAULT,
+                        help="Aumento absoluto por llamada por debajo del cual no se marca regresión.")
+    args = parser.parse_args(argv)
+
+    print(f"Benchmarks ({platform.python_implementation()} {platform.python_version()}, mejor de {args.repeticiones} muestras, ms por llamada):")
+    resultados = ejecutar_benchmarks(args.tamanos, args.repeticiones)
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump({
+                "version": 1,
+                "python": platform.python_version(),
+                "maquina": platform.machine(),
+                "fecha": datetime.datetime.now().isoformat(timespec='seconds'),
+                "resultados": resultados
+            }, f, indent=2)
+        print(f"\nLínea base guardada en {args.guardar}.")
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            linea_base = json.load(f).get("resultados", {})
+        regresiones = comparar_con_linea_base(resultados, linea_base, args.tolerancia, args.diferencia_minima_ms)
+        if regresiones:
+            print(f"\n{len(regresiones)} casos con regresión.")
+            return 1
+        print("\nSin regresiones.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
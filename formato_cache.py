@@ -0,0 +1,144 @@
+import os
+import json
+import mmap
+import zlib
+import threading
+
+# Formato de los archivos de caché de Sheets. Cada archivo empieza con una
+# línea de cabecera de texto y sigue con el contenido serializado:
+#
+#   #fdcache <versión> <formato> <crc32 hex> <largo en bytes>\n<contenido>
+#
+# El formato puede ser 'json' (compacto, legible con 'tail -n +2') o
+# 'msgpack' (más chico y rápido de leer, requiere el paquete msgpack). La
+# escritura es atómica (archivo temporal + os.replace), de modo que un lector
+# nunca ve un archivo a medio escribir, y el CRC detecta archivos dañados.
+# Los archivos JSON sin cabecera (formato anterior) se siguen leyendo.
+
+VERSION_FORMATO = 1
+FORMATOS = ('json', 'msgpack')
+_PREFIJO_CABECERA = b'#fdcache '
+_LARGO_MAX_CABECERA = 128
+
+# Contenido ya verificado (CRC) por ruta, junto con la firma del archivo del
+# que salió. Mientras el archivo no cambie, leer_cache no vuelve a leerlo ni a
+# verificarlo: solo lo decodifica, así cada llamada recibe objetos propios y un
+# consumidor que los modifique no afecta a los demás.
+_lock_decodificados = threading.Lock()
+_decodificados = {}
+
+
+class CacheInvalida(ValueError):
+    """El archivo de caché está truncado, dañado o tiene una versión no soportada."""
+
+
+def _serializar(datos, formato):
+    if formato == 'msgpack':
+        try:
+            import msgpack
+            return msgpack.packb(datos, use_bin_type=True), 'msgpack'
+        except ImportError:
+            print("Advertencia: Módulo 'msgpack' no instalado. La caché se guardará en JSON.")
+    return json.dumps(datos, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 'json'
+
+
+def _deserializar(contenido, formato):
+    if formato == 'json':
+        return json.loads(bytes(contenido))
+    if formato == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise CacheInvalida("La caché está en formato msgpack pero el módulo 'msgpack' no está instalado.")
+        return msgpack.unpackb(contenido, raw=False)
+    raise CacheInvalida(f"Formato de caché desconocido: '{formato}'.")
+
+
+def escribir_cache(ruta_archivo, datos, formato='json'):
+    """Guarda 'datos' en ruta_archivo de forma atómica, con cabecera de versión y CRC."""
+    if formato not in FORMATOS:
+        print(f"Advertencia: Formato de caché '{formato}' desconocido. Se usa JSON.")
+        formato = 'json'
+    contenido, formato = _serializar(datos, formato)
+    cabecera = f"#fdcache {VERSION_FORMATO} {formato} {zlib.crc32(contenido):08x} {len(contenido)}\n".encode('ascii')
+
+    ruta_temporal = f"{ruta_archivo}.tmp{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(ruta_temporal, 'wb') as f:
+            f.write(cabecera)
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta_temporal, ruta_archivo)
+    except BaseException:
+        try:
+            os.remove(ruta_temporal)
+        except OSError:
+            pass
+        raise
+
+
+def _decodificar_verificado(contenido, formato, ruta_archivo):
+    try:
+        return _deserializar(contenido, formato)
+    except CacheInvalida:
+        raise
+    except Exception as e:
+        raise CacheInvalida(f"Caché '{ruta_archivo}' inválida: {e}")
+
+
+def _extraer_contenido(memoria, ruta_archivo):
+    """Verifica cabecera, largo y CRC. Devuelve (contenido en bytes, formato)."""
+    if bytes(memoria[:len(_PREFIJO_CABECERA)]) != _PREFIJO_CABECERA:
+        # Formato anterior: JSON plano (posiblemente con indentación).
+        return bytes(memoria), 'json'
+
+    fin_cabecera = bytes(memoria[:_LARGO_MAX_CABECERA]).find(b'\n')
+    if fin_cabecera < 0:
+        raise CacheInvalida(f"Caché '{ruta_archivo}' con cabecera incompleta.")
+    try:
+        _, version, formato, crc_hex, largo = bytes(memoria[:fin_cabecera]).decode('ascii').split(' ')
+        version, crc_esperado, largo = int(version), int(crc_hex, 16), int(largo)
+    except ValueError:
+        raise CacheInvalida(f"Caché '{ruta_archivo}' con cabecera mal formada.")
+    if version != VERSION_FORMATO:
+        raise CacheInvalida(f"Caché '{ruta_archivo}' en versión {version} (se esperaba {VERSION_FORMATO}).")
+
+    # Vista sin copia sobre el mmap; se libera antes de cerrar el mapeo.
+    contenido = memoria[fin_cabecera + 1:]
+    try:
+        if len(contenido) != largo:
+            raise CacheInvalida(f"Caché '{ruta_archivo}' truncada o dañada: {len(contenido)} bytes, se esperaban {largo}.")
+        if zlib.crc32(contenido) != crc_esperado:
+            raise CacheInvalida(f"Caché '{ruta_archivo}' dañada: el CRC no coincide.")
+        return bytes(contenido), formato
+    finally:
+        contenido.release()
+
+
+def leer_cache(ruta_archivo):
+    """
+    Devuelve el contenido de la caché. Lanza FileNotFoundError si no existe y
+    CacheInvalida si está truncada o dañada. El archivo se lee con mmap y, si no
+    cambió desde la última lectura, solo se decodifica el contenido ya
+    verificado, sin volver a leerlo ni a calcular el CRC.
+    """
+    with open(ruta_archivo, 'rb') as f:
+        info = os.fstat(f.fileno())
+        firma = (info.st_ino, info.st_mtime_ns, info.st_size)
+        with _lock_decodificados:
+            verificado = _decodificados.get(ruta_archivo)
+        if verificado is not None and verificado[0] == firma:
+            return _decodificar_verificado(verificado[1], verificado[2], ruta_archivo)
+        if info.st_size == 0:
+            raise CacheInvalida(f"Caché '{ruta_archivo}' vacía.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as memoria:
+            vista = memoryview(memoria)
+            try:
+                contenido, formato = _extraer_contenido(vista, ruta_archivo)
+            finally:
+                vista.release()
+    datos = _decodificar_verificado(contenido, formato, ruta_archivo)
+    with _lock_decodificados:
+        _decodificados[ruta_archivo] = (firma, contenido, formato)
+    return datos
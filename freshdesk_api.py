@@ -0,0 +1,412 @@
+import re
+import time
+import threading
+import contextlib
+import grabacion
+
+# Punto único de salida hacia la API de Freshdesk. Las etapas siguen manejando
+# los objetos Response de requests como antes; este módulo solo se encarga de
+# lo que es común a todas las llamadas: grabación/reproducción de tráfico, el
+# límite de solicitudes por minuto compartido por todas las etapas, el plazo
+# máximo de cada etapa y la caché de lecturas del ciclo.
+# requests se importa recién en la primera llamada para no pagar su carga en
+# el arranque.
+
+TIMEOUT_SOLICITUD_SEGUNDOS = 30
+MAX_ESPERA_RETRY_AFTER_SEGUNDOS = 60
+# /search/tickets entrega 30 tickets por página y como máximo 10 páginas.
+TICKETS_POR_PAGINA_BUSQUEDA = 30
+MAX_PAGINAS_BUSQUEDA = 10
+
+
+class TiempoEtapaAgotado(Exception):
+    """La etapa que hace la solicitud superó su plazo máximo."""
+
+
+def __getattr__(nombre):
+    # Permite 'except freshdesk_api.HTTPError' en las etapas sin importar requests al cargar el módulo.
+    if nombre == 'HTTPError':
+        import requests
+        return requests.exceptions.HTTPError
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+
+# --- Límite de solicitudes compartido (token buckets) ---
+# El límite por minuto se reparte en una cubeta por cada etapa con cupo
+# reservado y una cubeta común con el resto. Una etapa usa primero su cupo,
+# después el común, y por último puede tomar prestado de la cubeta de otra
+# etapa solo si está llena (es decir, cupo que esa etapa no está usando y que
+# se perdería). Así las etapas sin reserva (encuestas) aprovechan lo que sobra
+# sin dejar nunca sin cupo a las que atienden clientes.
+_lock_limite = threading.Lock()
+_limite_por_minuto = None
+_cubetas = {}  # nombre de etapa (None = común) -> {"capacidad", "por_segundo", "tokens"}
+_ultima_recarga = 0.0
+_bloqueado_hasta = 0.0
+
+# Etapa en curso en cada hilo (nombre, plazo y contadores).
+_contexto = threading.local()
+
+# --- Caché de lecturas del ciclo ---
+# Los GET exitosos se guardan por URL + params hasta el próximo iniciar_ciclo().
+# Si dos etapas piden lo mismo a la vez, solo una solicitud sale a la red y la
+# otra espera su respuesta. Una escritura exitosa sobre un ticket descarta las
+# lecturas de ese ticket y las búsquedas/listados, que podrían incluirlo.
+# Cada escritura además incrementa un contador de generación (al empezar y al
+# terminar): un GET que estaba en curso mientras tanto pudo leer el estado
+# anterior, así que su respuesta no se guarda ni se comparte.
+_lock_cache = threading.Lock()
+_cache_activa = False
+_lecturas = {}  # clave -> {"lista": Event, "respuesta": Response o None, "descartada": bool}
+_generaciones = {}  # ID de ticket escrito (None = escritura sin ID) -> cantidad de escrituras
+_escrituras_totales = 0
+_RE_TICKET = re.compile(r'/tickets/(\d+)')
+
+
+def _nueva_cubeta(por_minuto):
+    # Una cubeta con menos de una solicitud por minuto igual tiene que poder juntar un token.
+    capacidad = max(1.0, por_minuto) if por_minuto > 0 else 0.0
+    return {"capacidad": capacidad, "por_segundo": por_minuto / 60.0, "tokens": capacidad}
+
+
+def configurar_limite(solicitudes_por_minuto, reparto_por_etapa=None):
+    """
+    Fija el presupuesto de solicitudes por minuto para todas las etapas. None o 0
+    lo desactiva. reparto_por_etapa ({etapa: fracción}) reserva una parte del
+    límite para cada etapa indicada; el resto queda en la cubeta común.
+    """
+    global _limite_por_minuto, _ultima_recarga
+    reparto = {etapa: float(fraccion) for etapa, fraccion in (reparto_por_etapa or {}).items() if fraccion and fraccion > 0}
+    total_reservado = sum(reparto.values())
+    if total_reservado > 1:
+        print(f"Advertencia: El reparto del límite de API suma {total_reservado:.2f} (> 1). Se normaliza.")
+        reparto = {etapa: fraccion / total_reservado for etapa, fraccion in reparto.items()}
+        total_reservado = 1.0
+    with _lock_limite:
+        _limite_por_minuto = solicitudes_por_minuto if solicitudes_por_minuto and solicitudes_por_minuto > 0 else None
+        _cubetas.clear()
+        if _limite_por_minuto:
+            for nombre_etapa, fraccion in reparto.items():
+                _cubetas[nombre_etapa] = _nueva_cubeta(fraccion * _limite_por_minuto)
+            _cubetas[None] = _nueva_cubeta((1 - total_reservado) * _limite_por_minuto)
+        _ultima_recarga = time.monotonic()
+
+
+@contextlib.contextmanager
+def etapa(nombre_etapa, timeout_segundos=None):
+    """
+    Marca las solicitudes hechas por el hilo actual como pertenecientes a una
+    etapa. Si se indica timeout_segundos, las solicitudes posteriores al plazo
+    fallan con TiempoEtapaAgotado para que la etapa termine cuanto antes.
+    """
+    estado_etapa = {
+        "etapa": nombre_etapa,
+        "plazo": time.monotonic() + timeout_segundos if timeout_segundos else None,
+        "solicitudes": 0,
+        "lecturas_en_cache": 0,
+        "tickets_encontrados": 0,
+        "busco_tickets": False,
+        "fechas_tickets": {},
+        "cupo": {"reservado": 0, "comun": 0, "prestado": 0},
+        "espera_cupo": 0.0,
+        "tiempo_agotado": False
+    }
+    with continuar_etapa(estado_etapa):
+        yield estado_etapa
+
+
+def etapa_actual():
+    """Estado de la etapa del hilo actual (o None), para pasarlo a hilos auxiliares."""
+    return getattr(_contexto, 'estado', None)
+
+
+@contextlib.contextmanager
+def continuar_etapa(estado_etapa):
+    """Hace que las solicitudes de un hilo auxiliar cuenten para la etapa que lo lanzó."""
+    estado_anterior = getattr(_contexto, 'estado', None)
+    _contexto.estado = estado_etapa
+    try:
+        yield estado_etapa
+    finally:
+        _contexto.estado = estado_anterior
+
+
+@contextlib.contextmanager
+def sin_plazo():
+    """
+    Las solicitudes del hilo actual ignoran el plazo de la etapa. Es para la
+    segunda mitad de una operación de dos pasos (responder y luego asignar o
+    cerrar) que no debe quedar a medias porque se agotó el tiempo entre ambos.
+    """
+    anterior = getattr(_contexto, 'sin_plazo', False)
+    _contexto.sin_plazo = True
+    try:
+        yield
+    finally:
+        _contexto.sin_plazo = anterior
+
+
+def _segundos_restantes(estado_etapa):
+    if not estado_etapa or estado_etapa["plazo"] is None or getattr(_contexto, 'sin_plazo', False):
+        return None
+    restantes = estado_etapa["plazo"] - time.monotonic()
+    if restantes <= 0:
+        estado_etapa["tiempo_agotado"] = True
+        raise TiempoEtapaAgotado(f"La etapa '{estado_etapa['etapa']}' superó su tiempo máximo.")
+    return restantes
+
+
+def _tomar_cupo(nombre_etapa):
+    """Descuenta un token para la etapa. Devuelve el tipo de cupo usado o, si no hay, la espera en segundos."""
+    propia = _cubetas.get(nombre_etapa) if nombre_etapa is not None else None
+    if propia is not None and propia["tokens"] >= 1:
+        propia["tokens"] -= 1
+        return "reservado"
+    comun = _cubetas[None]
+    if comun["tokens"] >= 1:
+        comun["tokens"] -= 1
+        return "comun"
+    ajenas = [cubeta for nombre, cubeta in _cubetas.items() if nombre is not None and cubeta is not propia]
+    for cubeta in ajenas:
+        if cubeta["capacidad"] and cubeta["tokens"] >= cubeta["capacidad"]:
+            cubeta["tokens"] -= 1
+            return "prestado"
+
+    esperas = [(1 - cubeta["tokens"]) / cubeta["por_segundo"]
+               for cubeta in (propia, comun) if cubeta is not None and cubeta["por_segundo"] > 0]
+    esperas += [(cubeta["capacidad"] - cubeta["tokens"]) / cubeta["por_segundo"] for cubeta in ajenas if cubeta["por_segundo"] > 0]
+    return min(esperas) if esperas else 60.0
+
+
+def _esperar_turno(estado_etapa):
+    global _ultima_recarga
+    nombre_etapa = estado_etapa["etapa"] if estado_etapa else None
+    inicio_espera = time.monotonic()
+    while True:
+        with _lock_limite:
+            ahora = time.monotonic()
+            espera = _bloqueado_hasta - ahora
+            if espera <= 0:
+                if not _limite_por_minuto:
+                    return
+                for cubeta in _cubetas.values():
+                    cubeta["tokens"] = min(cubeta["capacidad"], cubeta["tokens"] + (ahora - _ultima_recarga) * cubeta["por_segundo"])
+                _ultima_recarga = ahora
+                cupo = _tomar_cupo(nombre_etapa)
+                if isinstance(cupo, str):
+                    if estado_etapa is not None:
+                        estado_etapa["cupo"][cupo] += 1
+                        estado_etapa["espera_cupo"] += ahora - inicio_espera
+                    return
+                espera = cupo
+        restantes = _segundos_restantes(estado_etapa)
+        if restantes is not None and espera >= restantes:
+            estado_etapa["tiempo_agotado"] = True
+            raise TiempoEtapaAgotado(f"La etapa '{estado_etapa['etapa']}' agotaría su tiempo esperando cupo de API.")
+        time.sleep(espera)
+
+
+def _registrar_limite_excedido(respuesta):
+    # Ante un 429 se frena a todas las etapas hasta que Freshdesk vuelva a aceptar solicitudes.
+    global _bloqueado_hasta
+    try:
+        segundos = float(respuesta.headers.get('Retry-After', 60))
+    except ValueError:
+        segundos = 60.0
+    segundos = min(segundos, MAX_ESPERA_RETRY_AFTER_SEGUNDOS)
+    with _lock_limite:
+        _bloqueado_hasta = max(_bloqueado_hasta, time.monotonic() + segundos)
+        for cubeta in _cubetas.values():
+            cubeta["tokens"] = 0.0
+    print(f"Advertencia: Freshdesk respondió 429 (límite de API). Pausando solicitudes {segundos:.0f} s.")
+
+
+def _solicitar(metodo, url, **kwargs):
+    auth = kwargs.get('auth')
+    if auth:
+        grabacion.registrar_secreto(auth[0])
+    params = kwargs.get('params')
+
+    estado_etapa = getattr(_contexto, 'estado', None)
+    _segundos_restantes(estado_etapa)
+    if estado_etapa is not None:
+        # La etapa puede tener hilos auxiliares (p.ej. descarga anticipada de páginas).
+        with _lock_limite:
+            estado_etapa["solicitudes"] += 1
+
+    if grabacion.reproduciendo():
+        return grabacion.reproducir_http(metodo, url, params)
+
+    import requests
+
+    _esperar_turno(estado_etapa)
+    restantes = _segundos_restantes(estado_etapa)
+    timeout = TIMEOUT_SOLICITUD_SEGUNDOS if restantes is None else min(TIMEOUT_SOLICITUD_SEGUNDOS, restantes)
+    kwargs.setdefault('timeout', timeout)
+
+    inicio = time.perf_counter()
+    try:
+        respuesta = requests.request(metodo, url, **kwargs)
+    except Exception as e:
+        if grabacion.grabando():
+            grabacion.registrar_http(metodo, url, params, kwargs.get('json'), None, time.perf_counter() - inicio, error=e)
+        raise
+    if grabacion.grabando():
+        grabacion.registrar_http(metodo, url, params, kwargs.get('json'), respuesta, time.perf_counter() - inicio)
+    if respuesta.status_code == 429:
+        _registrar_limite_excedido(respuesta)
+    return respuesta
+
+
+def iniciar_ciclo(cache_lecturas=True):
+    """Vacía la caché de lecturas; se llama al comienzo de cada ciclo."""
+    global _cache_activa
+    with _lock_cache:
+        _lecturas.clear()
+        _generaciones.clear()
+        _cache_activa = bool(cache_lecturas)
+
+
+def _clave_lectura(url, params):
+    return url + '?' + '&'.join(f"{clave}={valor}" for clave, valor in sorted((params or {}).items()))
+
+
+def _generacion_lectura(clave):
+    # Se llama con _lock_cache tomado. Una lectura de ticket depende de las
+    # escrituras sobre ese ticket y de las masivas; una búsqueda, de todas.
+    ticket_leido = _RE_TICKET.search(clave.split('?', 1)[0])
+    if ticket_leido is None:
+        return _escrituras_totales
+    return (_generaciones.get(None, 0), _generaciones.get(ticket_leido.group(1), 0))
+
+
+def _registrar_escritura(url):
+    global _escrituras_totales
+    ticket_escrito = _RE_TICKET.search(url)
+    with _lock_cache:
+        id_ticket = ticket_escrito.group(1) if ticket_escrito else None
+        _generaciones[id_ticket] = _generaciones.get(id_ticket, 0) + 1
+        _escrituras_totales += 1
+
+
+def _invalidar_por_escritura(url):
+    _registrar_escritura(url)
+    ticket_escrito = _RE_TICKET.search(url)
+    with _lock_cache:
+        for clave in list(_lecturas):
+            ticket_leido = _RE_TICKET.search(clave.split('?', 1)[0])
+            # Sin ID en la escritura (p.ej. bulk_update) se descarta todo.
+            if ticket_escrito is None or ticket_leido is None or ticket_leido.group(1) == ticket_escrito.group(1):
+                del _lecturas[clave]
+
+
+def _contar_lectura_en_cache():
+    estado_etapa = getattr(_contexto, 'estado', None)
+    if estado_etapa is not None:
+        with _lock_limite:
+            estado_etapa["lecturas_en_cache"] += 1
+
+
+def registrar_tickets_encontrados(tickets, fecha_llegada=None):
+    """
+    Registra en la etapa actual que una búsqueda terminó bien y lo que devolvió.
+    De cada ticket se guarda su fecha de llegada (created_at, o lo que devuelva
+    fecha_llegada; None = no es una llegada) para que el planificador cuente solo
+    los que llegaron desde la consulta anterior de la etapa.
+    """
+    estado_etapa = getattr(_contexto, 'estado', None)
+    if estado_etapa is None:
+        return
+    with _lock_limite:
+        estado_etapa["busco_tickets"] = True
+        estado_etapa["tickets_encontrados"] += len(tickets)
+        for ticket in tickets:
+            fecha = fecha_llegada(ticket) if fecha_llegada else ticket.get('created_at')
+            if fecha:
+                estado_etapa["fechas_tickets"][str(ticket.get('id'))] = fecha
+
+
+def get(url, usar_cache=True, **kwargs):
+    """
+    GET con caché del ciclo. usar_cache=False para consultas cuyo resultado
+    cambia mientras se las repite (p.ej. el estado de un job).
+    """
+    if not (usar_cache and _cache_activa):
+        return _solicitar('GET', url, **kwargs)
+
+    clave = _clave_lectura(url, kwargs.get('params'))
+    with _lock_cache:
+        entrada = _lecturas.get(clave)
+        es_lider = entrada is None
+        if es_lider:
+            entrada = {"lista": threading.Event(), "respuesta": None, "descartada": False}
+            _lecturas[clave] = entrada
+            generacion = _generacion_lectura(clave)
+
+    if not es_lider:
+        if not entrada["lista"].wait(_segundos_restantes(etapa_actual())):
+            estado_etapa = etapa_actual()
+            estado_etapa["tiempo_agotado"] = True
+            raise TiempoEtapaAgotado(f"La etapa '{estado_etapa['etapa']}' superó su tiempo máximo esperando una lectura en curso.")
+        if entrada["respuesta"] is not None and not entrada["descartada"]:
+            _contar_lectura_en_cache()
+            return entrada["respuesta"]
+        # La solicitud original falló con una excepción o se cruzó con una
+        # escritura: se intenta por cuenta propia.
+        return _solicitar('GET', url, **kwargs)
+
+    try:
+        entrada["respuesta"] = _solicitar('GET', url, **kwargs)
+        return entrada["respuesta"]
+    finally:
+        # Solo quedan en caché las respuestas exitosas; las demás se comparten
+        # con quienes estaban esperando pero no con lecturas posteriores. Si hubo
+        # una escritura mientras tanto, la respuesta no se guarda ni se comparte.
+        with _lock_cache:
+            entrada["descartada"] = _generacion_lectura(clave) != generacion
+            if entrada["descartada"] or entrada["respuesta"] is None or not entrada["respuesta"].ok:
+                if _lecturas.get(clave) is entrada:
+                    del _lecturas[clave]
+        entrada["lista"].set()
+
+
+def buscar_tickets(domain, api_key, query_string, max_paginas=MAX_PAGINAS_BUSQUEDA):
+    """
+    Recorre todas las páginas de /search/tickets para la consulta y devuelve los
+    tickets encontrados. Lanza HTTPError si falla alguna página, para que quien
+    llama no confunda un error con "no hay tickets".
+    """
+    url = f"https://{domain}.freshdesk.com/api/v2/search/tickets"
+    tickets = []
+    for pagina in range(1, max_paginas + 1):
+        params = {'query': f'"{query_string}"'}
+        if pagina > 1:
+            params['page'] = pagina
+        respuesta = get(url, auth=(api_key, 'x'), params=params)
+        respuesta.raise_for_status()
+        datos = respuesta.json()
+        resultados = datos.get('results', [])
+        tickets.extend(resultados)
+        registrar_tickets_encontrados(resultados)
+        total = datos.get('total')
+        if len(resultados) < TICKETS_POR_PAGINA_BUSQUEDA or (total is not None and len(tickets) >= total):
+            return tickets
+    print(f"Advertencia: La búsqueda '{query_string}' alcanzó el máximo de {max_paginas} páginas "
+          f"({len(tickets)} tickets). Los restantes se verán en próximos ciclos.")
+    return tickets
+
+
+def post(url, **kwargs):
+    _registrar_escritura(url)
+    respuesta = _solicitar('POST', url, **kwargs)
+    if respuesta.ok:
+        _invalidar_por_escritura(url)
+    return respuesta
+
+
+def put(url, **kwargs):
+    _registrar_escritura(url)
+    respuesta = _solicitar('PUT', url, **kwargs)
+    if respuesta.ok:
+        _invalidar_por_escritura(url)
+    return respuesta
@@ -1,8 +1,18 @@
-import requests
+import freshdesk_api
+import grabacion
+import prioridad_tickets
+import latencias
 import datetime
+import time
 import os
 
 ESTADO_CERRADO_FRESHDESK = 5 
+# Cierre masivo con /tickets/bulk_update: Freshdesk devuelve un job que se consulta hasta que termina.
+TAMANO_LOTE_CIERRE_DEFAULT = 100
+MAX_TAMANO_LOTE_CIERRE = 100  # máximo de IDs que acepta bulk_update
+MAX_CONSULTAS_JOB_LOTE = 10
+SEGUNDOS_ENTRE_CONSULTAS_JOB = 2
+ESTADOS_JOB_EN_CURSO = ('IN PROGRESS', 'QUEUED', 'IN_PROGRESS')
 
 def _cargar_ids_procesados_fuera_horario(ruta_completa_archivo):
     if not os.path.exists(ruta_completa_archivo): return set()
@@ -20,74 +30,154 @@ def _guardar_id_procesado_fuera_horario(ticket_id, ruta_completa_archivo):
     except Exception as e:
         print(f"Error guardando ID (fuera horario) {ticket_id} en '{ruta_completa_archivo}': {e}")
 
+def ids_respondidos_fuera_horario(archivos_estado_config, script_dir):
+    """IDs de tickets que ya recibieron la respuesta de fuera de horario (los usa el asignador para omitirlos)."""
+    archivo_procesados_nombre = archivos_estado_config.get('fuera_horario_procesados', 'fuera_horario_procesados.txt')
+    return _cargar_ids_procesados_fuera_horario(os.path.join(script_dir, archivo_procesados_nombre))
+
 def _obtener_tickets_recientes_sin_respuesta_agente(fd_domain, fd_api_key, minutos_antiguedad_max):
-    url = f"https://{fd_domain}.freshdesk.com/api/v2/search/tickets"
     ahora_utc = datetime.datetime.now(datetime.timezone.utc)
     hace_x_minutos_utc = ahora_utc - datetime.timedelta(minutes=minutos_antiguedad_max)
     timestamp_limite = hace_x_minutos_utc.strftime("'%Y-%m-%dT%H:%M:%SZ'")
     # status < 4 (Nuevo, Abierto, Pendiente) y sin agente asignado
     query_string = f"created_at:>{timestamp_limite} AND.gitignore status:<4 AND agent_id:null" 
-    params = {'query': f'"{query_string}"'}
-    response_obj = None
     try:
-        response_obj = requests.get(url, auth=(fd_api_key, 'x'), params=params)
-        response_obj.raise_for_status()
-        data = response_obj.json()
-        return data.get('results', [])
-    except requests.exceptions.HTTPError as http_err:
+        # Todas las páginas: el orden por prioridad/SLA tiene que ver todos los tickets.
+        # Los errores se propagan para que la etapa figure con error: si no, el
+        # planificador la daría por exitosa, achicaría la próxima ventana de
+        # búsqueda y los tickets de este intervalo no se volverían a buscar.
+        return freshdesk_api.buscar_tickets(fd_domain, fd_api_key, query_string)
+    except freshdesk_api.HTTPError as http_err:
         error_msg = f"Error HTTP (fuera horario - obtener tickets): {http_err}"
-        if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
+        if http_err.response is not None: error_msg += f"\nServer: {http_err.response.text}"
         print(error_msg)
-    except Exception as e: print(f"Error (fuera horario - obtener tickets): {e}")
-    return []
+        raise
+    except Exception as e:
+        print(f"Error (fuera horario - obtener tickets): {e}")
+        raise
 
-def _enviar_respuesta_y_cerrar_ticket_fd(fd_domain, fd_api_key, ticket_id, mensaje_body):
+def _enviar_respuesta_fuera_horario_fd(fd_domain, fd_api_key, ticket_id, mensaje_body):
     url_reply = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}/reply"
     headers = {"Content-Type": "application/json"}
     data_reply = {"body": mensaje_body}
     response_obj_reply = None
     try:
-        response_obj_reply = requests.post(url_reply, auth=(fd_api_key, 'x'), headers=headers, json=data_reply)
+        response_obj_reply = freshdesk_api.post(url_reply, auth=(fd_api_key, 'x'), headers=headers, json=data_reply)
         response_obj_reply.raise_for_status()
         print(f"✅ Mensaje de fuera de horario enviado al ticket #{ticket_id}.")
-        url_update = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}"
-        # Payload para cerrar el ticket. Freshdesk podría requerir otros campos obligatorios
-        # si se actualiza el estado, pero usualmente status es suficiente.
-        data_update = {"status": ESTADO_CERRADO_FRESHDESK} 
-        response_obj_update = None
-        try:
-            response_obj_update = requests.put(url_update, auth=(fd_api_key, 'x'), json=data_update)
-            response_obj_update.raise_for_status()
-            print(f"✅ Ticket #{ticket_id} cerrado después de enviar mensaje de fuera de horario.")
-            return True
-        except requests.exceptions.HTTPError as http_err_update:
-            error_msg_update = f"❌ Error HTTP cerrando ticket #{ticket_id} (fuera horario): {http_err_update}"
-            if response_obj_update and hasattr(response_obj_update, 'text'): error_msg_update += f"\nServer: {response_obj_update.text}"
-            print(error_msg_update)
-        except Exception as e_update: print(f"❌ Error cerrando ticket #{ticket_id} (fuera horario): {e_update}")
-    except requests.exceptions.HTTPError as http_err_reply:
+        return True
+    except freshdesk_api.HTTPError as http_err_reply:
         error_msg_reply = f"❌ Error HTTP enviando respuesta (fuera horario) {ticket_id}: {http_err_reply}"
         if response_obj_reply and hasattr(response_obj_reply, 'text'): error_msg_reply += f"\nServer: {response_obj_reply.text}"
         print(error_msg_reply)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e_reply: print(f"❌ Error enviando respuesta (fuera horario) {ticket_id}: {e_reply}")
     return False
 
+def _cerrar_ticket_fd(fd_domain, fd_api_key, ticket_id):
+    url_update = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}"
+    # Payload para cerrar el ticket. Freshdesk podría requerir otros campos obligatorios
+    # si se actualiza el estado, pero usualmente status es suficiente.
+    data_update = {"status": ESTADO_CERRADO_FRESHDESK} 
+    response_obj_update = None
+    try:
+        response_obj_update = freshdesk_api.put(url_update, auth=(fd_api_key, 'x'), json=data_update)
+        response_obj_update.raise_for_status()
+        print(f"✅ Ticket #{ticket_id} cerrado después de enviar mensaje de fuera de horario.")
+        return True
+    except freshdesk_api.HTTPError as http_err_update:
+        error_msg_update = f"❌ Error HTTP cerrando ticket #{ticket_id} (fuera horario): {http_err_update}"
+        if response_obj_update and hasattr(response_obj_update, 'text'): error_msg_update += f"\nServer: {response_obj_update.text}"
+        print(error_msg_update)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
+    except Exception as e_update: print(f"❌ Error cerrando ticket #{ticket_id} (fuera horario): {e_update}")
+    return False
+
+def _esperar_resultado_job_fd(fd_domain, fd_api_key, job_id):
+    """
+    Consulta el job de una actualización masiva hasta que termina (o se agotan
+    los intentos) y devuelve {ticket_id: True/False} con el resultado por ticket.
+    """
+    url_job = f"https://{fd_domain}.freshdesk.com/api/v2/jobs/{job_id}"
+    for _ in range(MAX_CONSULTAS_JOB_LOTE):
+        time.sleep(SEGUNDOS_ENTRE_CONSULTAS_JOB)
+        response_obj = None
+        try:
+            response_obj = freshdesk_api.get(url_job, usar_cache=False, auth=(fd_api_key, 'x'))
+            response_obj.raise_for_status()
+            job = response_obj.json()
+        except freshdesk_api.HTTPError as http_err:
+            error_msg = f"Error HTTP (FH) consultando job {job_id}: {http_err}"
+            if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
+            print(error_msg)
+            return {}
+        except freshdesk_api.TiempoEtapaAgotado:
+            raise
+        except Exception as e:
+            print(f"Error (FH) consultando job {job_id}: {e}")
+            return {}
+        if str(job.get('status', '')).upper() in ESTADOS_JOB_EN_CURSO:
+            continue
+        return {str(item.get('id')): bool(item.get('success')) for item in job.get('data', [])}
+    print(f"Advertencia (FH): El job {job_id} no terminó tras {MAX_CONSULTAS_JOB_LOTE} consultas.")
+    return {}
+
+def _cerrar_tickets_en_lote_fd(fd_domain, fd_api_key, ticket_ids, tamano_lote):
+    """
+    Cierra los tickets con /tickets/bulk_update en lotes de 'tamano_lote'.
+    Devuelve {ticket_id: True/False}. Los tickets cuyo resultado no se pudo
+    confirmar en el job se cierran uno por uno como respaldo.
+    """
+    url_bulk = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/bulk_update"
+    resultados = {}
+    for inicio_lote in range(0, len(ticket_ids), tamano_lote):
+        lote = ticket_ids[inicio_lote:inicio_lote + tamano_lote]
+        data_bulk = {"bulk_action": {"ids": [int(t_id) for t_id in lote],
+                                     "properties": {"status": ESTADO_CERRADO_FRESHDESK}}}
+        resultados_lote = {}
+        response_obj = None
+        try:
+            response_obj = freshdesk_api.post(url_bulk, auth=(fd_api_key, 'x'), json=data_bulk)
+            response_obj.raise_for_status()
+            job_id = response_obj.json().get('job_id')
+            if job_id:
+                resultados_lote = _esperar_resultado_job_fd(fd_domain, fd_api_key, job_id)
+        except freshdesk_api.HTTPError as http_err:
+            error_msg = f"❌ Error HTTP cerrando lote de {len(lote)} tickets (fuera horario): {http_err}"
+            if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
+            print(error_msg)
+        except freshdesk_api.TiempoEtapaAgotado:
+            raise
+        except Exception as e:
+            print(f"❌ Error cerrando lote de {len(lote)} tickets (fuera horario): {e}")
+
+        for ticket_id in lote:
+            if resultados_lote.get(ticket_id):
+                print(f"✅ Ticket #{ticket_id} cerrado (lote).")
+                resultados[ticket_id] = True
+            else:
+                print(f"Ticket #{ticket_id} sin cierre confirmado en el lote. Reintentando individualmente.")
+                resultados[ticket_id] = _cerrar_ticket_fd(fd_domain, fd_api_key, ticket_id)
+    return resultados
+
 def _get_current_datetime_with_timezone_fh(timezone_str=None): 
     try:
         import pytz
         if timezone_str:
             try:
                 tz = pytz.timezone(timezone_str)
-                return datetime.datetime.now(tz)
+                return grabacion.ahora(tz) or datetime.datetime.now(tz)
             except pytz.UnknownTimeZoneError:
                 print(f"Advertencia (FH): Timezone '{timezone_str}' desconocido. Usando hora local del servidor.")
                 return datetime.datetime.now()
         else: 
-            return datetime.datetime.now()
+            return grabacion.ahora() or datetime.datetime.now()
     except ImportError:
         if timezone_str: 
             print("Advertencia (FH): Módulo 'pytz' no instalado. Timezone no se aplicará. Usando hora local del servidor.")
-        return datetime.datetime.now()
+        return grabacion.ahora() or datetime.datetime.now()
 
 def _esta_fuera_de_horario_atencion(horario_config):
     hora_inicio_str = horario_config.get("hora_inicio")
@@ -140,15 +230,22 @@ def ejecutar_proceso_fuera_de_horario(
     archivo_procesados_nombre = archivos_estado_config.get('fuera_horario_procesados', 'fuera_horario_procesados.txt')
     # Usar el parámetro específico para fuera de horario si existe, sino default.
     minutos_antiguedad_max_busqueda = params_app_config.get('minutos_antiguedad_max_busqueda_fh', 60) 
+    try:
+        tamano_lote_cierre = min(MAX_TAMANO_LOTE_CIERRE, max(1, int(params_app_config.get('tamano_lote_cierre_fh', TAMANO_LOTE_CIERRE_DEFAULT))))
+    except (TypeError, ValueError):
+        print(f"Advertencia (FH): tamano_lote_cierre_fh inválido. Se usa {TAMANO_LOTE_CIERRE_DEFAULT}.")
+        tamano_lote_cierre = TAMANO_LOTE_CIERRE_DEFAULT
+    max_tickets_por_ciclo = params_app_config.get('max_tickets_por_ciclo', {}).get('fuera_horario')
+    minutos_urgencia_sla = params_app_config.get('minutos_urgencia_sla', prioridad_tickets.MINUTOS_URGENCIA_SLA_DEFAULT)
 
     if not all([fd_api_key, fd_domain, plantilla_mensaje_fh, config_horario_general]):
         print("Error (FH): Faltan configuraciones esenciales.")
         print("--- Proceso de Fuera de Horario Finalizado ---")
-        return
+        return 0
 
     if not _esta_fuera_de_horario_atencion(config_horario_general):
         print("--- Proceso de Fuera de Horario Finalizado (dentro de horario) ---")
-        return
+        return 0
     
     print("Estamos FUERA del horario de atención. Buscando tickets para procesar...")
 
@@ -164,30 +261,46 @@ def ejecutar_proceso_fuera_de_horario(
     if not tickets_a_revisar:
         print("No se encontraron tickets recientes (según criterio) para procesar por fuera de horario.")
         print("--- Proceso de Fuera de Horario Finalizado ---")
-        return
+        return 0
 
     procesados_en_esta_ejecucion = 0
-    for ticket_info in tickets_a_revisar:
-        ticket_id_actual = str(ticket_info['id'])
+    ids_respondidos = []
+    tickets_nuevos = [t for t in tickets_a_revisar if str(t['id']) not in ids_ya_procesados]
+    try:
+        # Los más urgentes (SLA por vencer, prioridad, antigüedad) se responden primero.
+        for ticket_info in prioridad_tickets.tickets_por_prioridad(tickets_nuevos, max_tickets_por_ciclo, minutos_urgencia_sla):
+            ticket_id_actual = str(ticket_info['id'])
 
-        if ticket_id_actual in ids_ya_procesados:
-            continue
-        
-        print(f"\nProcesando ticket #{ticket_id_actual} por fuera de horario...")
-        
-        try:
-            mensaje_final_con_ticket_id = plantilla_mensaje_fh.format(ticket_id=ticket_id_actual)
-        except KeyError as ke:
-            print(f"Advertencia (FH): La plantilla MENSAJE_FUERA_HORARIO no usa {{ticket_id}} o falta otro placeholder. Error: {ke}")
-            mensaje_final_con_ticket_id = plantilla_mensaje_fh # Usar sin formatear si falla ticket_id
-
-        if _enviar_respuesta_y_cerrar_ticket_fd(fd_domain, fd_api_key, ticket_id_actual, mensaje_final_con_ticket_id):
-            _guardar_id_procesado_fuera_horario(ticket_id_actual, ruta_archivo_procesados)
-            procesados_en_esta_ejecucion += 1
+            print(f"\nProcesando ticket #{ticket_id_actual} por fuera de horario...")
+            
+            try:
+                mensaje_final_con_ticket_id = plantilla_mensaje_fh.format(ticket_id=ticket_id_actual)
+            except KeyError as ke:
+                print(f"Advertencia (FH): La plantilla MENSAJE_FUERA_HORARIO no usa {{ticket_id}} o falta otro placeholder. Error: {ke}")
+                mensaje_final_con_ticket_id = plantilla_mensaje_fh # Usar sin formatear si falla ticket_id
+
+            # El ID se guarda apenas se envía la respuesta para no responder dos veces
+            # al mismo ticket si luego falla el cierre.
+            if _enviar_respuesta_fuera_horario_fd(fd_domain, fd_api_key, ticket_id_actual, mensaje_final_con_ticket_id):
+                _guardar_id_procesado_fuera_horario(ticket_id_actual, ruta_archivo_procesados)
+                latencias.registrar('respuesta_fuera_horario', ticket_id_actual, ticket_info.get('created_at'))
+                ids_respondidos.append(ticket_id_actual)
+                procesados_en_esta_ejecucion += 1
+    finally:
+        # Los ya respondidos se cierran aunque la etapa se haya cortado (p.ej. por
+        # tiempo agotado): si no, quedarían abiertos y marcados como procesados.
+        if ids_respondidos:
+            print(f"\nCerrando {len(ids_respondidos)} tickets respondidos (lotes de hasta {tamano_lote_cierre})...")
+            with freshdesk_api.sin_plazo():
+                resultados_cierre = _cerrar_tickets_en_lote_fd(fd_domain, fd_api_key, ids_respondidos, tamano_lote_cierre)
+            ids_sin_cerrar = [t_id for t_id, cerrado in resultados_cierre.items() if not cerrado]
+            if ids_sin_cerrar:
+                print(f"Advertencia (FH): No se pudieron cerrar {len(ids_sin_cerrar)} tickets: {', '.join(ids_sin_cerrar)}")
         
     if procesados_en_esta_ejecucion > 0:
         print(f"Se procesaron {procesados_en_esta_ejecucion} tickets por fuera de horario.")
     else:
         print("No hubo nuevos tickets (que no estuvieran ya procesados) para fuera de horario en esta ejecución.")
     
-    print("--- Proceso de Fuera de Horario Finalizado ---")
\ No newline at end of file
+    print("--- Proceso de Fuera de Horario Finalizado ---")
+    return procesados_en_esta_ejecucion
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import time
+import grabacion
+import formato_cache
 from datetime import datetime, timedelta
 
 # --- Constantes (igual que antes para la hoja de agentes) ---
@@ -18,9 +19,86 @@ DIAS_SEMANA_COLUMNAS = {
     4: 'Viernes', 5: 'Sabado', 6: 'Domingo'
 }
 ESTADO_SHEET_ACTIVO = 'activo'
+MINUTOS_POR_DIA = 24 * 60
+MINUTOS_POR_SEMANA = 7 * MINUTOS_POR_DIA
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+CLAVES_CACHES_SHEETS = ('mapa_agentes_cache', 'agentes_operativos_cache', 'configuracion_global_cache')
+ARCHIVO_ESTADO_CACHES_DEFAULT = 'cache_sheets_estado.json'
+
+
+def _ruta_estado_caches(archivos_estado_config):
+    return os.path.join(SCRIPT_DIR, archivos_estado_config.get('estado_caches_sheets', ARCHIVO_ESTADO_CACHES_DEFAULT))
+
+def _escribir_json_atomico(ruta_archivo, datos, **opciones_json):
+    # Archivo temporal + rename: el ciclo puede estar leyendo mientras la
+    # actualización en segundo plano escribe, y nunca debe ver un archivo a medias.
+    ruta_temporal = f"{ruta_archivo}.tmp{os.getpid()}"
+    try:
+        with open(ruta_temporal, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, **opciones_json)
+        os.replace(ruta_temporal, ruta_archivo)
+    except BaseException:
+        try:
+            os.remove(ruta_temporal)
+        except OSError:
+            pass
+        raise
+
+def cargar_estado_caches(archivos_estado_config):
+    """Momento (epoch) de la última obtención exitosa de cada caché y datos del último intento."""
+    ruta_estado = _ruta_estado_caches(archivos_estado_config)
+    if not os.path.exists(ruta_estado):
+        return {}
+    try:
+        with open(ruta_estado, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Advertencia: No se pudo leer el estado de las cachés '{ruta_estado}': {e}")
+        return {}
+
+def _guardar_estado_caches(archivos_estado_config, obtenidas, error):
+    estado = cargar_estado_caches(archivos_estado_config)
+    for clave, momento in obtenidas.items():
+        estado.setdefault(clave, {})["obtenida"] = momento
+    estado["ultimo_intento"] = time.time()
+    estado["ultimo_error"] = error
+    try:
+        _escribir_json_atomico(_ruta_estado_caches(archivos_estado_config), estado, indent=2)
+    except Exception as e:
+        print(f"Advertencia: No se pudo guardar el estado de las cachés: {e}")
+
+def antiguedad_caches_minutos(archivos_estado_config, ahora=None):
+    """
+    Minutos transcurridos desde que se obtuvo cada caché de Sheets (None si el
+    archivo no existe). Para cachés escritas antes de que existiera el archivo
+    de estado se usa la fecha de modificación.
+    """
+    ahora = ahora if ahora is not None else time.time()
+    estado = cargar_estado_caches(archivos_estado_config)
+    antiguedades = {}
+    for clave in CLAVES_CACHES_SHEETS:
+        nombre_archivo = archivos_estado_config.get(clave)
+        ruta_cache = os.path.join(SCRIPT_DIR, nombre_archivo) if nombre_archivo else None
+        if not ruta_cache or not os.path.exists(ruta_cache):
+            antiguedades[clave] = None
+            continue
+        obtenida = estado.get(clave, {}).get("obtenida") or os.path.getmtime(ruta_cache)
+        antiguedades[clave] = max(0.0, (ahora - obtenida) / 60.0)
+    return antiguedades
+
+def caches_vigentes(archivos_estado_config, minutos_vigencia):
+    """
+    Indica si los tres archivos de caché existen y fueron obtenidos hace
+    menos de 'minutos_vigencia' minutos. Permite saltear la consulta a Sheets
+    (y la importación de gspread) en las ejecuciones en las que no hace falta.
+    """
+    if not minutos_vigencia or minutos_vigencia <= 0:
+        return False
+    antiguedades = antiguedad_caches_minutos(archivos_estado_config)
+    return all(antiguedad is not None and antiguedad < minutos_vigencia for antiguedad in antiguedades.values())
+
 def _parse_horario_string(horario_str):
     if not horario_str or str(horario_str).strip().lower() == 'off':
         return None, None
@@ -96,29 +174,182 @@ def _is_on_active_break(descanso_inicio_hora_str, ahora_dt, duracion_descanso_mi
         return False
 
 
+def _hora_a_minuto_del_dia(hora_str):
+    partes = str(hora_str).strip().split(':')
+    if len(partes) != 2:
+        raise ValueError(f"hora '{hora_str}' no tiene formato HH:MM")
+    horas, minutos = int(partes[0]), int(partes[1])
+    if not (0 <= horas < 24 and 0 <= minutos < 60):
+        raise ValueError(f"hora '{hora_str}' fuera de rango")
+    return horas * 60 + minutos
+
+def _mascara_intervalo_diario(inicio_min, fin_min):
+    """
+    Bits de los minutos del día en [inicio_min, fin_min). Si el intervalo cruza
+    la medianoche se parte dentro del mismo día (de inicio a 24:00 y de 00:00 a
+    fin), con el mismo criterio que _is_currently_on_shift.
+    """
+    if inicio_min <= fin_min:
+        return ((1 << (fin_min - inicio_min)) - 1) << inicio_min
+    return (((1 << (MINUTOS_POR_DIA - inicio_min)) - 1) << inicio_min) | ((1 << fin_min) - 1)
+
+def minuto_de_la_semana(ahora_dt):
+    return ahora_dt.weekday() * MINUTOS_POR_DIA + ahora_dt.hour * 60 + ahora_dt.minute
+
+def compilar_horarios_agentes(registros_agentes, duracion_descanso_min=DURACION_DESCANSO_MINUTOS):
+    """
+    Compila la hoja de agentes a una máscara de bits por agente activo con los
+    10080 minutos de la semana (1 = en turno y fuera de descanso). Si NumPy está
+    disponible las máscaras se empaquetan además en una matriz uint8 de
+    (agentes x 1260) para consultar a todos los agentes de una vez.
+    """
+    ids_agentes_activos = []
+    mascaras = []
+    mapa_agentes = {}
+    mascara_descanso_semana_cache = {}
+
+    for i, fila_agente in enumerate(registros_agentes):
+        agent_id_str = str(fila_agente.get(COL_AGENT_ID, '')).strip()
+        agent_name = str(fila_agente.get(COL_AGENT_NAME, '')).strip()
+        if not agent_id_str or not agent_name:
+            continue
+        try:
+            agent_id = int(agent_id_str)
+        except ValueError:
+            print(f"Error procesando fila de agente {i+2}: Agent_ID '{agent_id_str}' no es un número válido. Omitiendo agente.")
+            continue
+        mapa_agentes[str(agent_id)] = agent_name
+
+        if str(fila_agente.get(COL_STATUS, '')).strip().lower() != ESTADO_SHEET_ACTIVO:
+            continue
+
+        mascara_semana = 0
+        for dia_num, prefijo_dia_col in DIAS_SEMANA_COLUMNAS.items():
+            for sufijo in (COL_SUFFIX_HORARIO1, COL_SUFFIX_HORARIO2):
+                inicio_str, fin_str = _parse_horario_string(str(fila_agente.get(f"{prefijo_dia_col}{sufijo}", '')).strip())
+                if not inicio_str or not fin_str:
+                    continue
+                try:
+                    mascara_dia = _mascara_intervalo_diario(_hora_a_minuto_del_dia(inicio_str), _hora_a_minuto_del_dia(fin_str))
+                except ValueError as e:
+                    print(f"Error parseando turno individual '{inicio_str}-{fin_str}' (agente {agent_id}, {prefijo_dia_col}): {e}")
+                    continue
+                mascara_semana |= mascara_dia << (dia_num * MINUTOS_POR_DIA)
+
+        descanso_inicio_str = str(fila_agente.get(COL_DESCANSO_INICIO_HORA, '')).strip()
+        if descanso_inicio_str:
+            try:
+                inicio_descanso = _hora_a_minuto_del_dia(descanso_inicio_str)
+            except ValueError:
+                print(f"Advertencia: Formato incorrecto para Descanso_Inicio_Hora: '{descanso_inicio_str}'. No se considera en descanso.")
+            else:
+                # El descanso se repite todos los días; si cruza la medianoche continúa a las 00:00.
+                mascara_descanso = mascara_descanso_semana_cache.get(inicio_descanso)
+                if mascara_descanso is None:
+                    fin_descanso = (inicio_descanso + duracion_descanso_min) % MINUTOS_POR_DIA
+                    if duracion_descanso_min >= MINUTOS_POR_DIA:
+                        mascara_descanso_dia = (1 << MINUTOS_POR_DIA) - 1
+                    else:
+                        mascara_descanso_dia = _mascara_intervalo_diario(inicio_descanso, fin_descanso)
+                    mascara_descanso = 0
+                    for dia_num in range(7):
+                        mascara_descanso |= mascara_descanso_dia << (dia_num * MINUTOS_POR_DIA)
+                    mascara_descanso_semana_cache[inicio_descanso] = mascara_descanso
+                mascara_semana &= ~mascara_descanso
+
+        ids_agentes_activos.append(str(agent_id))
+        mascaras.append(mascara_semana)
+
+    return {
+        "ids": ids_agentes_activos,
+        "mascaras": mascaras,
+        "matriz": _matriz_horarios(mascaras),
+        "mapa_agentes": mapa_agentes
+    }
+
+def _matriz_horarios(mascaras):
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    bytes_por_agente = MINUTOS_POR_SEMANA // 8
+    return np.frombuffer(
+        b''.join(m.to_bytes(bytes_por_agente, 'little') for m in mascaras), dtype=np.uint8
+    ).reshape(len(mascaras), bytes_por_agente)
+
+def horarios_a_cache(horarios_compilados):
+    """Forma serializable (JSON/msgpack) de los horarios compilados: las máscaras van en hexadecimal."""
+    return {
+        "ids": horarios_compilados["ids"],
+        "mascaras": [format(mascara, 'x') for mascara in horarios_compilados["mascaras"]]
+    }
+
+def horarios_desde_cache(datos_cache):
+    """Inversa de horarios_a_cache. Lanza ValueError si los datos no tienen ese formato."""
+    try:
+        ids = [str(agent_id) for agent_id in datos_cache["ids"]]
+        mascaras = [int(mascara, 16) for mascara in datos_cache["mascaras"]]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"horarios de agentes inválidos: {e}")
+    if len(ids) != len(mascaras):
+        raise ValueError("horarios de agentes inválidos: cantidad de IDs y de máscaras distinta")
+    return {"ids": ids, "mascaras": mascaras, "matriz": _matriz_horarios(mascaras), "mapa_agentes": {}}
+
+def agentes_disponibles(horarios_compilados, minuto_semana):
+    """IDs (en el orden de la hoja) de los agentes en turno y fuera de descanso en ese minuto de la semana."""
+    ids = horarios_compilados["ids"]
+    matriz = horarios_compilados["matriz"]
+    if matriz is not None:
+        import numpy as np
+        columna = matriz[:, minuto_semana >> 3]
+        return [ids[i] for i in np.flatnonzero((columna >> (minuto_semana & 7)) & 1)]
+    return [agent_id for agent_id, mascara in zip(ids, horarios_compilados["mascaras"]) if (mascara >> minuto_semana) & 1]
+
+def agentes_disponibles_en(horarios_compilados, instante_dt):
+    """Agentes disponibles en un instante cualquiera (hora local de la planilla), útil también para planificación."""
+    return agentes_disponibles(horarios_compilados, minuto_de_la_semana(instante_dt))
+
+
+def agentes_operativos_ahora(horarios_compilados, timezone_str=None):
+    """Agentes disponibles en este momento, en la zona horaria de la aplicación (TIMEZONE_APP)."""
+    return agentes_disponibles_en(horarios_compilados, _get_current_datetime_with_timezone(timezone_str))
+
+
 def _get_current_datetime_with_timezone(timezone_str=None):
     try:
         import pytz # Asegurarse que pytz se importa aquí
         if timezone_str:
             try:
                 tz = pytz.timezone(timezone_str)
-                return datetime.now(tz) # Esto devuelve un datetime aware
+                return grabacion.ahora(tz) or datetime.now(tz) # Esto devuelve un datetime aware
             except pytz.UnknownTimeZoneError:
                 print(f"Advertencia: Timezone '{timezone_str}' desconocido. Usando hora local del servidor (naive).")
                 return datetime.now() # Fallback a naive datetime
         else:
-            return datetime.now() # Hora local del servidor (naive)
+            return grabacion.ahora() or datetime.now() # Hora local del servidor (naive)
     except ImportError:
         if timezone_str:
             print("Advertencia: Módulo 'pytz' no instalado. Timezone no se aplicará. Usando hora local del servidor (naive).")
-        return datetime.now() # Fallback a naive datetime
+        return grabacion.ahora() or datetime.now() # Fallback a naive datetime
+
+
+def _leer_registros_hoja(client, planilla_nombre, hoja_nombre):
+    # Durante la reproducción de un cassette no hay cliente: los registros salen de la grabación.
+    if grabacion.reproduciendo():
+        return grabacion.reproducir_hoja(planilla_nombre, hoja_nombre)
+    inicio = time.perf_counter()
+    registros = client.open(planilla_nombre).worksheet(hoja_nombre).get_all_records()
+    if grabacion.grabando():
+        grabacion.registrar_hoja(planilla_nombre, hoja_nombre, registros, time.perf_counter() - inicio)
+    return registros
 
 
 def _cargar_configuracion_global_desde_sheet(client, planilla_nombre, hoja_config_nombre):
+    import gspread
+
     config_global = {}
     try:
-        hoja_config = client.open(planilla_nombre).worksheet(hoja_config_nombre)
-        registros_config = hoja_config.get_all_records() 
+        registros_config = _leer_registros_hoja(client, planilla_nombre, hoja_config_nombre)
 
         for fila in registros_config:
             clave = fila.get('ClaveConfig')
@@ -142,7 +373,12 @@ def _cargar_configuracion_global_desde_sheet(client, planilla_nombre, hoja_confi
     return config_global
 
 
-def ejecutar_actualizacion_caches(gs_config, archivos_estado_config):
+def ejecutar_actualizacion_caches(gs_config, archivos_estado_config, formato_caches='json'):
+    # Devuelve True si las tres cachés se actualizaron.
+    # gspread y google-auth son las dependencias más pesadas del proyecto: se
+    # importan solo cuando realmente hay que consultar Sheets.
+    import gspread
+
     print("--- Iniciando Actualización de Caches desde Google Sheets ---")
     
     ruta_credenciales_gs = os.path.join(SCRIPT_DIR, gs_config['credentials_file'])
@@ -157,24 +393,29 @@ def ejecutar_actualizacion_caches(gs_config, archivos_estado_config):
     agentes_operativos_ids = []
     todos_los_agentes_map = {}
     configuracion_global_sheet = {}
+    obtenidas = {}
+    error = None
 
     try:
-        scopes = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = Credentials.from_service_account_file(ruta_credenciales_gs, scopes=scopes)
-        client = gspread.authorize(creds)
+        client = None
+        if not grabacion.reproduciendo():
+            from google.oauth2.service_account import Credentials
+            scopes = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            creds = Credentials.from_service_account_file(ruta_credenciales_gs, scopes=scopes)
+            client = gspread.authorize(creds)
 
         configuracion_global_sheet = _cargar_configuracion_global_desde_sheet(
             client, planilla_nombre_gs, hoja_config_global_nombre_gs
         )
         if configuracion_global_sheet:
-            with open(ruta_config_global_cache, 'w', encoding='utf-8') as f:
-                json.dump(configuracion_global_sheet, f, ensure_ascii=False, indent=2)
+            formato_cache.escribir_cache(ruta_config_global_cache, configuracion_global_sheet, formato_caches)
+            obtenidas['configuracion_global_cache'] = time.time()
             print(f"Caché de configuración global guardada en: {ruta_config_global_cache}")
         else:
+            error = "No se pudo cargar la configuración global desde Sheets."
             print("No se pudo cargar la configuración global desde Sheets. No se actualizó la caché.")
 
-        hoja_agentes = client.open(planilla_nombre_gs).worksheet(hoja_agentes_nombre_gs)
-        registros_agentes = hoja_agentes.get_all_records()
+        registros_agentes = _leer_registros_hoja(client, planilla_nombre_gs, hoja_agentes_nombre_gs)
 
         timezone_aplicacion = configuracion_global_sheet.get('TIMEZONE_APP')
         ahora_con_timezone = _get_current_datetime_with_timezone(timezone_aplicacion) # Esta función ahora puede devolver naive si pytz falla o no hay timezone_str
@@ -186,67 +427,39 @@ def ejecutar_actualizacion_caches(gs_config, archivos_estado_config):
             print(f"Fecha y hora actual (Naive - Local del Servidor): {ahora_con_timezone.strftime('%Y-%m-%d %H:%M:%S')}")
 
 
-        dia_actual_num = ahora_con_timezone.weekday()
-        prefijo_dia_col = DIAS_SEMANA_COLUMNAS.get(dia_actual_num)
+        # La hoja se compila una sola vez a máscaras de minutos de la semana. Se
+        # guardan los horarios compilados y no la lista de operativos de este
+        # momento: app.py los evalúa en cada ciclo con la hora actual.
+        horarios_compilados = compilar_horarios_agentes(registros_agentes)
+        todos_los_agentes_map = horarios_compilados["mapa_agentes"]
+        agentes_operativos_ids = agentes_disponibles_en(horarios_compilados, ahora_con_timezone)
 
-        if not prefijo_dia_col:
-            print(f"Error: No se pudo determinar el prefijo de columna para el día {dia_actual_num}.")
-            return 
-
-        col_h1_hoy = f"{prefijo_dia_col}{COL_SUFFIX_HORARIO1}" 
-        col_h2_hoy = f"{prefijo_dia_col}{COL_SUFFIX_HORARIO2}" 
-
-        for i, fila_agente in enumerate(registros_agentes):
-            try:
-                agent_id_str = str(fila_agente.get(COL_AGENT_ID, '')).strip()
-                agent_name = str(fila_agente.get(COL_AGENT_NAME, '')).strip()
-                if not agent_id_str or not agent_name:
-                    continue
-
-                agent_id = int(agent_id_str) 
-                todos_los_agentes_map[str(agent_id)] = agent_name
-
-                status_general = str(fila_agente.get(COL_STATUS, '')).strip().lower()
-                
-                h1_str_hoy = str(fila_agente.get(col_h1_hoy, '')).strip()
-                h2_str_hoy = str(fila_agente.get(col_h2_hoy, '')).strip()
-                
-                desc_inicio_h_str = str(fila_agente.get(COL_DESCANSO_INICIO_HORA, '')).strip()
-
-                h1_ini, h1_fin = _parse_horario_string(h1_str_hoy)
-                h2_ini, h2_fin = _parse_horario_string(h2_str_hoy)
-                
-                en_turno_h1 = _is_currently_on_shift(h1_ini, h1_fin, ahora_con_timezone)
-                en_turno_h2 = _is_currently_on_shift(h2_ini, h2_fin, ahora_con_timezone)
-                en_turno_agente = en_turno_h1 or en_turno_h2
-                
-                en_descanso_agente = _is_on_active_break(desc_inicio_h_str, ahora_con_timezone)
-
-                if status_general == ESTADO_SHEET_ACTIVO and en_turno_agente and not en_descanso_agente:
-                    agentes_operativos_ids.append(str(agent_id)) 
-            except ValueError:
-                 print(f"Error procesando fila de agente {i+2}: Agent_ID '{agent_id_str}' no es un número válido. Omitiendo agente.")
-            except Exception as e_agente:
-                print(f"Error procesando fila de agente {i+2} (ID: {agent_id_str if 'agent_id_str' in locals() else 'desconocido'}): {e_agente}")
-
-        with open(ruta_mapa_agentes_cache, 'w', encoding='utf-8') as f:
-            json.dump(todos_los_agentes_map, f, ensure_ascii=False, indent=2)
+        formato_cache.escribir_cache(ruta_mapa_agentes_cache, todos_los_agentes_map, formato_caches)
+        obtenidas['mapa_agentes_cache'] = time.time()
         print(f"Caché de mapa de agentes guardada: {len(todos_los_agentes_map)} agentes.")
 
-        with open(ruta_agentes_operativos_cache, 'w', encoding='utf-8') as f:
-            json.dump(agentes_operativos_ids, f, indent=2) 
-        print(f"Caché de IDs de agentes operativos guardada: {len(agentes_operativos_ids)} agentes.")
+        formato_cache.escribir_cache(ruta_agentes_operativos_cache, horarios_a_cache(horarios_compilados), formato_caches)
+        obtenidas['agentes_operativos_cache'] = time.time()
+        print(f"Caché de horarios de agentes guardada: {len(horarios_compilados['ids'])} agentes activos, "
+              f"{len(agentes_operativos_ids)} operativos en este momento.")
 
     except gspread.exceptions.SpreadsheetNotFound:
+        error = f"Planilla '{planilla_nombre_gs}' no encontrada."
         print(f"ERROR: Planilla '{planilla_nombre_gs}' no encontrada.")
     except gspread.exceptions.WorksheetNotFound as e:
+        error = f"Hoja no encontrada: {e}"
         print(f"ERROR: Hoja no encontrada en la planilla '{planilla_nombre_gs}'. Detalle: {e}")
     except FileNotFoundError:
+        error = f"Archivo de credenciales '{ruta_credenciales_gs}' no encontrado."
         print(f"ERROR: Archivo de credenciales '{ruta_credenciales_gs}' no encontrado.")
     except Exception as e:
+        error = str(e)
         print(f"ERROR CRÍTICO ejecutando actualización de cachés: {e}")
-    
+
+    # Cada caché lleva la hora en que se obtuvo de Sheets; las que fallaron conservan la anterior.
+    _guardar_estado_caches(archivos_estado_config, obtenidas, error)
     print("--- Actualización de Caches desde Google Sheets Finalizada ---")
+    return error is None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import gzip
+import time
+import threading
+import datetime
+from collections import deque
+
+# Grabación y reproducción del tráfico con Freshdesk y Google Sheets.
+# En modo grabación cada par solicitud/respuesta se agrega a un "cassette"
+# (JSON por línea, comprimido con gzip). En modo reproducción las etapas
+# reciben las respuestas grabadas sin tocar la red, lo que permite perfilar
+# un ciclo real de producción en cualquier máquina.
+
+VERSION_CASSETTE = 1
+TEXTO_REDACTADO = "***REDACTADO***"
+CABECERAS_A_GRABAR = ('content-type', 'retry-after', 'x-ratelimit-total',
+                      'x-ratelimit-remaining', 'x-ratelimit-used-currentrequest')
+
+# Fechas dentro de las queries de búsqueda (dependen de la hora de ejecución).
+_PATRON_FECHA_QUERY = re.compile(r"'\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}Z)?'")
+
+_lock = threading.Lock()
+_modo = None  # None, 'grabar' o 'reproducir'
+_archivo_grabacion = None
+_secretos = set()
+_respuestas_http = {}
+_registros_hojas = {}
+_respetar_tiempos = False
+_grabado_en = None
+_inicio_reproduccion = None
+
+
+def grabando():
+    return _modo == 'grabar'
+
+
+def reproduciendo():
+    return _modo == 'reproducir'
+
+
+def registrar_secreto(valor):
+    """Registra un valor (p.ej. la API key) que nunca debe llegar al cassette."""
+    if valor:
+        _secretos.add(str(valor))
+
+
+def _redactar(texto):
+    if texto is None:
+        return None
+    for secreto in _secretos:
+        texto = texto.replace(secreto, TEXTO_REDACTADO)
+    return texto
+
+
+def _normalizar_params(params):
+    if not params:
+        return ""
+    normalizados = []
+    for clave in sorted(params):
+        valor = _PATRON_FECHA_QUERY.sub("'<fecha>'", str(params[clave]))
+        normalizados.append(f"{clave}={valor}")
+    return "&".join(normalizados)
+
+
+def _clave_http(metodo, url, params):
+    return f"{metodo.upper()} {url.split('?')[0]} {_normalizar_params(params)}"
+
+
+def _escribir_entrada(entrada):
+    linea = json.dumps(entrada, ensure_ascii=False, separators=(',', ':'))
+    with _lock:
+        if _archivo_grabacion is not None:
+            _archivo_grabacion.write(_redactar(linea) + "\n")
+
+
+def iniciar_grabacion(ruta_cassette):
+    global _modo, _archivo_grabacion
+    _archivo_grabacion = gzip.open(ruta_cassette, 'wt', encoding='utf-8')
+    _modo = 'grabar'
+    _escribir_entrada({
+        "tipo": "cabecera",
+        "version": VERSION_CASSETTE,
+        "grabado_en": datetime.datetime.now(datetime.timezone.utc).isoformat()
+    })
+    print(f"Grabación de tráfico activada. Cassette: {ruta_cassette}")
+
+
+def iniciar_reproduccion(ruta_cassette, respetar_tiempos=False):
+    global _modo, _respetar_tiempos, _grabado_en, _inicio_reproduccion
+    if not os.path.exists(ruta_cassette):
+        raise FileNotFoundError(f"Cassette '{ruta_cassette}' no encontrado.")
+    _respuestas_http.clear()
+    _registros_hojas.clear()
+    total_entradas = 0
+    with gzip.open(ruta_cassette, 'rt', encoding='utf-8') as f:
+        for linea in f:
+            if not linea.strip():
+                continue
+            entrada = json.loads(linea)
+            tipo = entrada.get('tipo')
+            if tipo == 'cabecera':
+                if entrada.get('version') != VERSION_CASSETTE:
+                    raise ValueError(f"Versión de cassette no soportada: {entrada.get('version')}")
+                _grabado_en = datetime.datetime.fromisoformat(entrada['grabado_en'])
+            elif tipo == 'http':
+                clave = _clave_http(entrada['metodo'], entrada['url'], entrada.get('params'))
+                _respuestas_http.setdefault(clave, deque()).append(entrada)
+            elif tipo == 'hoja':
+                clave = (entrada['planilla'], entrada['hoja'])
+                _registros_hojas.setdefault(clave, deque()).append(entrada)
+            total_entradas += 1
+    _respetar_tiempos = respetar_tiempos
+    _inicio_reproduccion = time.monotonic()
+    _modo = 'reproducir'
+    print(f"Reproducción de tráfico activada: {total_entradas} entradas desde '{ruta_cassette}'"
+          f"{' (respetando tiempos originales)' if respetar_tiempos else ''}.")
+
+
+def finalizar():
+    global _modo, _archivo_grabacion
+    with _lock:
+        if _archivo_grabacion is not None:
+            _archivo_grabacion.close()
+            _archivo_grabacion = None
+    _modo = None
+
+
+def ahora(tz=None):
+    """
+    Hora de referencia durante la reproducción: la hora en que se grabó el
+    cassette más el tiempo transcurrido desde que empezó la reproducción.
+    Devuelve None fuera de la reproducción.
+    """
+    if not reproduciendo() or _grabado_en is None:
+        return None
+    instante = _grabado_en + datetime.timedelta(seconds=time.monotonic() - _inicio_reproduccion)
+    return instante.astimezone(tz) if tz is not None else instante.astimezone().replace(tzinfo=None)
+
+
+def registrar_http(metodo, url, params, cuerpo_json, respuesta, duracion_seg, error=None):
+    entrada = {
+        "tipo": "http",
+        "metodo": metodo.upper(),
+        "url": url,
+        "params": params or None,
+        "json": cuerpo_json,
+        "duracion": round(duracion_seg, 4)
+    }
+    if error is not None:
+        entrada["error"] = f"{type(error).__name__}: {error}"
+    else:
+        entrada["status"] = respuesta.status_code
+        entrada["motivo"] = respuesta.reason
+        entrada["cabeceras"] = {k: v for k, v in respuesta.headers.items() if k.lower() in CABECERAS_A_GRABAR}
+        entrada["contenido"] = respuesta.text
+    _escribir_entrada(entrada)
+
+
+def reproducir_http(metodo, url, params):
+    import requests
+
+    clave = _clave_http(metodo, url, params)
+    with _lock:
+        cola = _respuestas_http.get(clave)
+        entrada = cola.popleft() if cola else None
+    if entrada is None:
+        raise requests.exceptions.ConnectionError(f"Solicitud no grabada en el cassette: {clave}")
+    if _respetar_tiempos:
+        time.sleep(entrada.get('duracion', 0))
+    if 'error' in entrada:
+        raise requests.exceptions.ConnectionError(f"(reproducido) {entrada['error']}")
+
+    respuesta = requests.models.Response()
+    respuesta.status_code = entrada['status']
+    respuesta.reason = entrada.get('motivo', '')
+    respuesta.headers = requests.structures.CaseInsensitiveDict(entrada.get('cabeceras', {}))
+    respuesta._content = (entrada.get('contenido') or '').encode('utf-8')
+    respuesta.encoding = 'utf-8'
+    respuesta.url = url
+    return respuesta
+
+
+def registrar_hoja(planilla_nombre, hoja_nombre, registros, duracion_seg):
+    _escribir_entrada({
+        "tipo": "hoja",
+        "planilla": planilla_nombre,
+        "hoja": hoja_nombre,
+        "registros": registros,
+        "duracion": round(duracion_seg, 4)
+    })
+
+
+def reproducir_hoja(planilla_nombre, hoja_nombre):
+    with _lock:
+        cola = _registros_hojas.get((planilla_nombre, hoja_nombre))
+        entrada = cola.popleft() if cola else None
+    if entrada is None:
+        raise LookupError(f"Hoja '{hoja_nombre}' de la planilla '{planilla_nombre}' no grabada en el cassette.")
+    if _respetar_tiempos:
+        time.sleep(entrada.get('duracion', 0))
+    return entrada['registros']
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import math
+import argparse
+import datetime
+import threading
+from collections import defaultdict
+import grabacion
+import formato_cache
+import prioridad_tickets
+
+# Latencia de punta a punta de cada ticket, vista por el cliente:
+#   saludo                   creación -> respuesta de apertura (ticket_assigner)
+#   asignacion               creación -> asignación a un agente (ticket_assigner)
+#   respuesta_fuera_horario  creación -> respuesta automática (fuera_horario)
+#   encuesta                 cierre -> envío de la encuesta (survey_sender)
+# Las etapas registran en memoria (pueden correr en paralelo) y app.py vuelca
+# todo al final del ciclo a un archivo JSON por línea. El reporte agrega
+# percentiles por hora del día (en TIMEZONE_APP, no en la hora del servidor)
+# y por agente:
+#   python latencias.py [--archivo latencias_tickets.jsonl] [--horas 24] [--zona-horaria America/Santiago] [--json reporte.json]
+
+ARCHIVO_LATENCIAS_DEFAULT = 'latencias_tickets.jsonl'
+PERCENTILES = (50, 90, 99)
+
+_lock = threading.Lock()
+_pendientes = []
+
+
+def _ahora_ts():
+    return (grabacion.ahora(datetime.timezone.utc) or datetime.datetime.now(datetime.timezone.utc)).timestamp()
+
+
+def registrar(metrica, ticket_id, desde_iso, agente_id=None):
+    """Registra cuánto pasó desde 'desde_iso' (fecha de Freshdesk) hasta ahora para el ticket."""
+    desde = prioridad_tickets.timestamp_freshdesk(desde_iso)
+    if desde is None:
+        return
+    fin = _ahora_ts()
+    with _lock:
+        _pendientes.append({
+            "metrica": metrica,
+            "ticket_id": str(ticket_id),
+            "agente": str(agente_id) if agente_id is not None else None,
+            "fin": fin,
+            "segundos": max(0.0, fin - desde)
+        })
+
+
+def volcar(ruta_archivo):
+    """Agrega al archivo los registros del ciclo y los devuelve."""
+    with _lock:
+        registros = list(_pendientes)
+        _pendientes.clear()
+    if not registros:
+        return registros
+    try:
+        with open(ruta_archivo, 'a', encoding='utf-8') as f:
+            for registro in registros:
+                f.write(json.dumps(registro, separators=(',', ':')) + "\n")
+    except Exception as e:
+        print(f"Advertencia: No se pudieron guardar las latencias en '{ruta_archivo}': {e}")
+    return registros
+
+
+def _percentil(valores_ordenados, p):
+    # Método del rango más cercano.
+    indice = max(0, math.ceil(p / 100.0 * len(valores_ordenados)) - 1)
+    return valores_ordenados[min(indice, len(valores_ordenados) - 1)]
+
+
+def _estadisticas(valores):
+    valores = sorted(valores)
+    resultado = {"cantidad": len(valores)}
+    for p in PERCENTILES:
+        resultado[f"p{p}"] = _percentil(valores, p)
+    resultado["max"] = valores[-1]
+    return resultado
+
+
+def _zona_horaria(nombre):
+    """tzinfo de 'nombre' (pytz); None si no se indicó o no se puede resolver (hora del servidor)."""
+    if not nombre:
+        return None
+    try:
+        import pytz
+        return pytz.timezone(nombre)
+    except ImportError:
+        print("Advertencia: Módulo 'pytz' no instalado. Las horas del reporte quedan en hora local del servidor.")
+    except Exception:
+        print(f"Advertencia: Timezone '{nombre}' desconocido. Las horas del reporte quedan en hora local del servidor.")
+    return None
+
+
+def zona_horaria_de_configuracion(ruta_config):
+    """TIMEZONE_APP de la caché de configuración global indicada en config.json (None si no está)."""
+    try:
+        with open(ruta_config, 'r', encoding='utf-8') as f:
+            archivos_estado = json.load(f).get('archivos_estado', {})
+        nombre_cache = archivos_estado.get('configuracion_global_cache')
+        if not nombre_cache:
+            return None
+        configuracion_global = formato_cache.leer_cache(os.path.join(os.path.dirname(ruta_config), nombre_cache))
+    except (OSError, ValueError, AttributeError):
+        return None
+    return configuracion_global.get('TIMEZONE_APP') if isinstance(configuracion_global, dict) else None
+
+
+def agregar(registros, tz=None):
+    """
+    Percentiles (en segundos) por métrica: en total, por hora del día y por
+    agente. Las horas se cuentan en 'tz' (la de TIMEZONE_APP); sin ella, en la
+    hora local del servidor.
+    """
+    por_metrica = defaultdict(list)
+    por_hora = defaultdict(lambda: defaultdict(list))
+    por_agente = defaultdict(lambda: defaultdict(list))
+    for registro in registros:
+        metrica, segundos = registro["metrica"], registro["segundos"]
+        por_metrica[metrica].append(segundos)
+        por_hora[metrica][datetime.datetime.fromtimestamp(registro["fin"], tz).hour].append(segundos)
+        if registro.get("agente"):
+            por_agente[metrica][registro["agente"]].append(segundos)
+    return {
+        metrica: {
+            "total": _estadisticas(valores),
+            "por_hora": {f"{hora:02d}": _estadisticas(v) for hora, v in sorted(por_hora[metrica].items())},
+            "por_agente": {agente: _estadisticas(v) for agente, v in sorted(por_agente[metrica].items())}
+        }
+        for metrica, valores in sorted(por_metrica.items())
+    }
+
+
+def cargar_registros(ruta_archivo, horas=None):
+    desde = _ahora_ts() - horas * 3600 if horas else None
+    registros = []
+    if not os.path.exists(ruta_archivo):
+        return registros
+    with open(ruta_archivo, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                registro = json.loads(linea)
+            except ValueError:
+                continue  # línea a medio escribir
+            if desde is None or registro.get("fin", 0) >= desde:
+                registros.append(registro)
+    return registros
+
+
+def _formatear_segundos(segundos):
+    return f"{segundos / 60:.1f}m" if segundos >= 120 else f"{segundos:.0f}s"
+
+
+def _linea_estadisticas(etiqueta, estadisticas):
+    percentiles = "  ".join(f"p{p} {_formatear_segundos(estadisticas[f'p{p}']):>7}" for p in PERCENTILES)
+    return f"  {etiqueta:<12} n={estadisticas['cantidad']:<5} {percentiles}  max {_formatear_segundos(estadisticas['max']):>7}"
+
+
+def imprimir_resumen(registros, titulo="Latencia de tickets"):
+    if not registros:
+        return
+    print(f"{titulo}:")
+    for metrica, agregados in agregar(registros).items():
+        print(_linea_estadisticas(metrica, agregados["total"]))
+
+
+def imprimir_reporte(agregados):
+    for metrica, datos in agregados.items():
+        print(f"\n=== {metrica} ===")
+        print(_linea_estadisticas("total", datos["total"]))
+        print(" Por hora:")
+        for hora, estadisticas in datos["por_hora"].items():
+            print(_linea_estadisticas(f"{hora}:00", estadisticas))
+        if datos["por_agente"]:
+            print(" Por agente:")
+            for agente, estadisticas in datos["por_agente"].items():
+                print(_linea_estadisticas(agente, estadisticas))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reporte de latencias de tickets (percentiles por hora y por agente).")
+    parser.add_argument('--archivo', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ARCHIVO_LATENCIAS_DEFAULT))
+    parser.add_argument('--horas', type=float, default=24, help="Ventana hacia atrás a considerar (0 = todo el archivo).")
+    parser.add_argument('--zona-horaria', help="Zona horaria de las horas del reporte (por defecto TIMEZONE_APP de la caché de configuración global).")
+    parser.add_argument('--json', metavar='ARCHIVO_JSON', help="Además guarda el reporte en formato JSON.")
+    args = parser.parse_args()
+
+    registros_reporte = cargar_registros(args.archivo, args.horas)
+    if not registros_reporte:
+        print(f"No hay latencias registradas en '{args.archivo}' para la ventana indicada.")
+        sys.exit(0)
+    nombre_zona_horaria = args.zona_horaria or zona_horaria_de_configuracion(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
+    tz_reporte = _zona_horaria(nombre_zona_horaria)
+    agregados_reporte = agregar(registros_reporte, tz_reporte)
+    print(f"Latencias de {len(registros_reporte)} eventos ({'todo el archivo' if not args.horas else f'últimas {args.horas:g} h'}, "
+          f"horas en {nombre_zona_horaria if tz_reporte else 'hora local del servidor'}):")
+    imprimir_reporte(agregados_reporte)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(agregados_reporte, f, indent=2)
+        print(f"\nReporte guardado en {args.json}.")
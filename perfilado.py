@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+import contextlib
+from collections import Counter
+
+# Perfilado opcional de las etapas del ciclo (app.py --perfil o
+# parametros_aplicacion.perfilado). Por cada etapa se guarda:
+#   <fecha>_<etapa>.pstats  -> cProfile, para abrir con pstats/snakeviz
+#   <fecha>_<etapa>.folded  -> pilas colapsadas por muestreo, para flamegraph.pl/speedscope
+# y se imprime un resumen de las funciones con más tiempo propio.
+# Desactivado, perfilar() no hace nada más que un chequeo de una variable.
+
+TOP_N_DEFAULT = 15
+INTERVALO_MUESTREO_SEGUNDOS = 0.005
+
+_activo = False
+_directorio_salida = None
+_top_n = TOP_N_DEFAULT
+
+# Muestreo de pilas: un hilo recorre sys._current_frames() y acumula las pilas
+# de los hilos registrados por cada etapa en curso.
+_lock_muestras = threading.Lock()
+_hilos_perfilados = {}  # ident del hilo -> Counter de pilas colapsadas
+_hilo_muestreo = None
+
+
+def activar(directorio_salida, top_n=TOP_N_DEFAULT):
+    global _activo, _directorio_salida, _top_n
+    os.makedirs(directorio_salida, exist_ok=True)
+    _directorio_salida = directorio_salida
+    _top_n = top_n
+    _activo = True
+
+
+def desactivar():
+    global _activo
+    _activo = False
+
+
+def activo():
+    return _activo
+
+
+def _pila_colapsada(frame):
+    marcos = []
+    while frame is not None:
+        codigo = frame.f_code
+        marcos.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(marcos))
+
+
+def _bucle_muestreo():
+    global _hilo_muestreo
+    ident_propio = threading.get_ident()
+    while True:
+        with _lock_muestras:
+            if not _hilos_perfilados:
+                _hilo_muestreo = None
+                return
+            idents = list(_hilos_perfilados)
+        marcos = sys._current_frames()
+        for ident in idents:
+            frame = marcos.get(ident)
+            if frame is None or ident == ident_propio:
+                continue
+            pila = _pila_colapsada(frame)
+            with _lock_muestras:
+                muestras = _hilos_perfilados.get(ident)
+                if muestras is not None:
+                    muestras[pila] += 1
+        time.sleep(INTERVALO_MUESTREO_SEGUNDOS)
+
+
+def _registrar_hilo_muestreo(ident):
+    global _hilo_muestreo
+    muestras = Counter()
+    with _lock_muestras:
+        _hilos_perfilados[ident] = muestras
+        if _hilo_muestreo is None:
+            _hilo_muestreo = threading.Thread(target=_bucle_muestreo, name='perfilado-muestreo', daemon=True)
+            _hilo_muestreo.start()
+    return muestras
+
+
+def _quitar_hilo_muestreo(ident):
+    with _lock_muestras:
+        return _hilos_perfilados.pop(ident, Counter())
+
+
+def _imprimir_resumen(nombre, estadisticas, top_n):
+    filas = sorted(estadisticas.stats.items(), key=lambda item: item[1][2], reverse=True)[:top_n]
+    print(f"Perfil de '{nombre}' ({estadisticas.total_tt:.3f} s perfilados). Top {len(filas)} por tiempo propio:")
+    print(f"  {'propio (s)':>10} {'acumulado (s)':>13} {'llamadas':>9}  función")
+    for (archivo, linea, funcion), (_, llamadas, tiempo_propio, tiempo_acumulado, _) in filas:
+        print(f"  {tiempo_propio:10.4f} {tiempo_acumulado:13.4f} {llamadas:9d}  {funcion} ({os.path.basename(archivo)}:{linea})")
+
+
+@contextlib.contextmanager
+def perfilar(nombre):
+    """Perfila el bloque si el perfilado está activo; si no, no hace nada."""
+    if not _activo:
+        yield
+        return
+
+    directorio, top_n = _directorio_salida, _top_n
+    ident = threading.get_ident()
+    _registrar_hilo_muestreo(ident)
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError as e:
+        # Desde Python 3.12 solo puede haber un perfilador activo a la vez (etapas concurrentes).
+        print(f"Advertencia: No se pudo iniciar cProfile para '{nombre}' ({e}). Solo se guardará el muestreo.")
+        perfil = None
+    try:
+        yield
+    finally:
+        if perfil is not None:
+            perfil.disable()
+        muestras = _quitar_hilo_muestreo(ident)
+        base_archivo = os.path.join(directorio, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{nombre}")
+        try:
+            with open(base_archivo + '.folded', 'w', encoding='utf-8') as f:
+                for pila, cantidad in muestras.most_common():
+                    f.write(f"{pila} {cantidad}\n")
+            if perfil is not None:
+                perfil.dump_stats(base_archivo + '.pstats')
+                _imprimir_resumen(nombre, pstats.Stats(perfil), top_n)
+            print(f"Perfil de '{nombre}' guardado en {base_archivo}.* ({sum(muestras.values())} muestras).")
+        except Exception as e:
+            print(f"Advertencia: No se pudo guardar el perfil de '{nombre}': {e}")
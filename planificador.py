@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import prioridad_tickets
+
+# Planificación adaptativa de las etapas. Cada etapa guarda una estimación
+# (media móvil exponencial) de su tasa de llegada de tickets y, a partir de
+# ella, el intervalo hasta su próxima consulta: corto en las horas pico y
+# largo cuando no entra nada. El estado se persiste en un JSON para que
+# funcione igual con cron (ejecutado con el intervalo mínimo) que en modo
+# continuo.
+
+INTERVALO_MIN_SEGUNDOS_DEFAULT = 60
+INTERVALO_MAX_SEGUNDOS_DEFAULT = 900
+TICKETS_OBJETIVO_POR_CONSULTA_DEFAULT = 1.0
+FACTOR_SUAVIZADO_DEFAULT = 0.3
+VENTANA_MAX_MINUTOS_DEFAULT = 24 * 60
+MARGEN_VENTANA_MINUTOS = 2
+
+
+def _parametro(config_planificacion, nombre_etapa, clave, default):
+    config_etapa = config_planificacion.get('etapas', {}).get(nombre_etapa, {})
+    return config_etapa.get(clave, config_planificacion.get(clave, default))
+
+
+def cargar_estado(ruta_archivo):
+    if not os.path.exists(ruta_archivo):
+        return {}
+    try:
+        with open(ruta_archivo, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Advertencia: No se pudo leer el estado del planificador '{ruta_archivo}': {e}. Se reinicia.")
+        return {}
+
+
+def guardar_estado(ruta_archivo, estado):
+    try:
+        with open(ruta_archivo, 'w', encoding='utf-8') as f:
+            json.dump(estado, f, indent=2)
+    except Exception as e:
+        print(f"Advertencia: No se pudo guardar el estado del planificador '{ruta_archivo}': {e}")
+
+
+def etapa_pendiente(estado, nombre_etapa, ahora=None):
+    ahora = ahora if ahora is not None else time.time()
+    return ahora >= estado.get(nombre_etapa, {}).get('proxima', 0)
+
+
+def segundos_hasta_proxima(estado, nombres_etapas, ahora=None):
+    ahora = ahora if ahora is not None else time.time()
+    proximas = [estado.get(nombre, {}).get('proxima', 0) for nombre in nombres_etapas]
+    return max(0.0, min(proximas) - ahora) if proximas else 0.0
+
+
+def minutos_ventana_busqueda(estado, nombre_etapa, minutos_minimos, config_planificacion, ahora=None):
+    """
+    Ventana de búsqueda (en minutos hacia atrás) que cubre todo lo ocurrido desde
+    la última consulta exitosa de la etapa, para que alargar el intervalo nunca
+    deje tickets sin ver.
+    """
+    ahora = ahora if ahora is not None else time.time()
+    ultima_exitosa = estado.get(nombre_etapa, {}).get('ultima_exitosa')
+    if not ultima_exitosa:
+        return minutos_minimos
+    minutos_desde_ultima = (ahora - ultima_exitosa) / 60.0 + MARGEN_VENTANA_MINUTOS
+    ventana_max = _parametro(config_planificacion, nombre_etapa, 'ventana_max_minutos', VENTANA_MAX_MINUTOS_DEFAULT)
+    return int(min(ventana_max, max(minutos_minimos, minutos_desde_ultima + 0.999)))
+
+
+def contar_llegadas(estado, nombre_etapa, fechas_tickets):
+    """
+    Cuántos de los tickets vistos ({id: fecha de Freshdesk}) llegaron después de
+    la consulta anterior de la etapa. Las búsquedas devuelven también tickets ya
+    vistos (backlog, tickets del día ya encuestados): esos no son llegadas.
+    """
+    desde = estado.get(nombre_etapa, {}).get('ultima_ejecucion')
+    marcas = [prioridad_tickets.timestamp_freshdesk(fecha) for fecha in fechas_tickets.values()]
+    return sum(1 for marca in marcas if marca is not None and (desde is None or marca > desde))
+
+
+def registrar_observacion(estado, nombre_etapa, tickets_nuevos, exitosa, config_planificacion, ahora=None):
+    """
+    Actualiza la tasa estimada de llegada de la etapa con los tickets vistos en
+    esta ejecución y recalcula su intervalo. Devuelve el intervalo en segundos.
+    """
+    ahora = ahora if ahora is not None else time.time()
+    intervalo_min = _parametro(config_planificacion, nombre_etapa, 'intervalo_min_segundos', INTERVALO_MIN_SEGUNDOS_DEFAULT)
+    intervalo_max = _parametro(config_planificacion, nombre_etapa, 'intervalo_max_segundos', INTERVALO_MAX_SEGUNDOS_DEFAULT)
+    objetivo = _parametro(config_planificacion, nombre_etapa, 'tickets_objetivo_por_consulta', TICKETS_OBJETIVO_POR_CONSULTA_DEFAULT)
+    alfa = _parametro(config_planificacion, nombre_etapa, 'factor_suavizado', FACTOR_SUAVIZADO_DEFAULT)
+
+    estado_etapa = estado.setdefault(nombre_etapa, {})
+    ultima_ejecucion = estado_etapa.get('ultima_ejecucion')
+    tasa = estado_etapa.get('tasa_por_minuto')
+
+    if ultima_ejecucion and ahora > ultima_ejecucion:
+        tasa_observada = tickets_nuevos / ((ahora - ultima_ejecucion) / 60.0)
+        tasa = tasa_observada if tasa is None else alfa * tasa_observada + (1 - alfa) * tasa
+
+    if tasa is None:
+        intervalo = intervalo_min
+    elif tasa <= 0:
+        intervalo = intervalo_max
+    else:
+        intervalo = min(intervalo_max, max(intervalo_min, objetivo / tasa * 60.0))
+
+    estado_etapa['ultima_ejecucion'] = ahora
+    if exitosa:
+        estado_etapa['ultima_exitosa'] = ahora
+    estado_etapa['tasa_por_minuto'] = tasa
+    estado_etapa['intervalo_segundos'] = intervalo
+    estado_etapa['proxima'] = ahora + intervalo
+    return intervalo
@@ -0,0 +1,59 @@
+import heapq
+import datetime
+import grabacion
+
+# Orden de atención de los tickets dentro de una etapa. Primero los que están
+# por vencer (o ya vencidos) su SLA, después por prioridad de Freshdesk
+# (4 urgente ... 1 baja), luego por vencimiento más cercano (fr_due_by o
+# due_by) y por último los más antiguos. Se usa un heap: armarlo es O(n) y
+# cada ticket que se toma cuesta O(log n), así que con un tope por ciclo no se
+# ordena todo el backlog.
+
+MINUTOS_URGENCIA_SLA_DEFAULT = 30
+PRIORIDAD_DEFAULT = 1
+_SIN_FECHA = float('inf')
+
+
+def timestamp_freshdesk(valor):
+    # Freshdesk devuelve fechas UTC como "2024-06-03T12:00:00Z".
+    if not valor:
+        return None
+    try:
+        return datetime.datetime.strptime(valor, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def clave_prioridad(ticket, ahora_ts, minutos_urgencia_sla=MINUTOS_URGENCIA_SLA_DEFAULT):
+    """Clave de orden del ticket: la menor se atiende primero."""
+    vencimientos = [ts for ts in (timestamp_freshdesk(ticket.get('fr_due_by')), timestamp_freshdesk(ticket.get('due_by'))) if ts is not None]
+    vencimiento = min(vencimientos) if vencimientos else _SIN_FECHA
+    por_vencer = vencimiento - ahora_ts <= minutos_urgencia_sla * 60
+    try:
+        prioridad = int(ticket.get('priority') or PRIORIDAD_DEFAULT)
+    except (TypeError, ValueError):
+        prioridad = PRIORIDAD_DEFAULT
+    creado = timestamp_freshdesk(ticket.get('created_at'))
+    return (
+        0 if por_vencer else 1,
+        -prioridad,
+        vencimiento,
+        creado if creado is not None else _SIN_FECHA,
+    )
+
+
+def tickets_por_prioridad(tickets, maximo=None, minutos_urgencia_sla=MINUTOS_URGENCIA_SLA_DEFAULT):
+    """
+    Devuelve los tickets de a uno, del más crítico al menos crítico, hasta
+    'maximo' (None o 0 = sin tope).
+    """
+    ahora_ts = (grabacion.ahora(datetime.timezone.utc) or datetime.datetime.now(datetime.timezone.utc)).timestamp()
+    # El índice desempata sin comparar los dicts y conserva el orden original entre iguales.
+    heap = [(clave_prioridad(ticket, ahora_ts, minutos_urgencia_sla), indice, ticket) for indice, ticket in enumerate(tickets)]
+    heapq.heapify(heap)
+    entregados = 0
+    while heap and (not maximo or entregados < maximo):
+        yield heapq.heappop(heap)[2]
+        entregados += 1
+    if heap:
+        print(f"Tope de {maximo} tickets por ciclo alcanzado: {len(heap)} quedan para el próximo ciclo.")
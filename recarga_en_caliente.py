@@ -0,0 +1,172 @@
+import os
+import sys
+import select
+import struct
+import threading
+
+# Recarga en caliente de config.json y de los archivos de caché para procesos
+# de larga duración (app.py --continuo). Un hilo observa los directorios de
+# los archivos (inotify en Linux; si no está disponible, sondeo de mtime) y,
+# cuando alguno cambia, vuelve a construir el estado completo de la aplicación
+# con la función de carga recibida. Si la carga falla (archivo inválido o a
+# medio escribir) se conserva el último estado bueno. El reemplazo es atómico:
+# quien ya tomó el estado con obtener_estado() sigue usando su versión hasta
+# terminar. Las recargas (hilo observador, actualización de cachés desde
+# Sheets) se serializan: una carga más vieja nunca pisa a una más nueva.
+
+INTERVALO_SONDEO_SEGUNDOS = 2.0
+ESPERA_AGRUPAR_CAMBIOS_SEGUNDOS = 0.2
+
+# Constantes de inotify (linux/inotify.h)
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_FORMATO_EVENTO = 'iIII'
+_TAMANO_EVENTO = struct.calcsize(_FORMATO_EVENTO)
+
+_lock = threading.Lock()
+# Cubre carga + reemplazo; obtener_estado() no lo toma, así que leer nunca espera a una recarga.
+_lock_carga = threading.Lock()
+_estado_vigente = None
+_version = 0
+_funcion_carga = None
+_detener = threading.Event()
+_hilo_observador = None
+
+
+def obtener_estado():
+    """Último estado válido cargado (no se modifica: cada recarga crea uno nuevo)."""
+    return _estado_vigente
+
+
+def version():
+    return _version
+
+
+def recargar_ahora(motivo="solicitud explícita"):
+    """Recarga y valida el estado; si falla, se mantiene el anterior. Devuelve True si se reemplazó."""
+    global _estado_vigente, _version
+    if _funcion_carga is None:
+        return False
+    with _lock_carga:
+        try:
+            nuevo_estado = _funcion_carga()
+        except Exception as e:
+            print(f"Recarga en caliente rechazada ({motivo}): {e}. Se mantiene la versión {_version}.")
+            return False
+        with _lock:
+            _estado_vigente = nuevo_estado
+            _version += 1
+            version_activa = _version
+    print(f"Recarga en caliente: estado versión {version_activa} activo ({motivo}).")
+    return True
+
+
+def _firmas_archivos(rutas):
+    firmas = {}
+    for ruta in rutas:
+        try:
+            info = os.stat(ruta)
+            firmas[ruta] = (info.st_mtime_ns, info.st_size)
+        except OSError:
+            firmas[ruta] = None
+    return firmas
+
+
+def _observar_por_sondeo(rutas, intervalo):
+    firmas = _firmas_archivos(rutas)
+    while not _detener.wait(intervalo):
+        firmas_nuevas = _firmas_archivos(rutas)
+        cambiados = [os.path.basename(r) for r in rutas if firmas_nuevas[r] != firmas[r]]
+        firmas = firmas_nuevas
+        if cambiados:
+            recargar_ahora(f"cambio en {', '.join(cambiados)}")
+
+
+def _iniciar_inotify(directorios):
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mascara = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_MODIFY
+        for directorio in directorios:
+            if libc.inotify_add_watch(fd, os.fsencode(directorio), mascara) < 0:
+                os.close(fd)
+                return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _nombres_en_eventos(datos):
+    nombres = set()
+    desplazamiento = 0
+    while desplazamiento + _TAMANO_EVENTO <= len(datos):
+        _, _, _, largo_nombre = struct.unpack_from(_FORMATO_EVENTO, datos, desplazamiento)
+        inicio_nombre = desplazamiento + _TAMANO_EVENTO
+        nombre = datos[inicio_nombre:inicio_nombre + largo_nombre].rstrip(b'\0')
+        if nombre:
+            nombres.add(os.fsdecode(nombre))
+        desplazamiento = inicio_nombre + largo_nombre
+    return nombres
+
+
+def _observar_con_inotify(fd, rutas):
+    nombres_observados = {os.path.basename(r) for r in rutas}
+    try:
+        while not _detener.is_set():
+            listos, _, _ = select.select([fd], [], [], 1.0)
+            if not listos:
+                continue
+            cambiados = set()
+            # Agrupa ráfagas de eventos (escritura + rename) en una sola recarga.
+            while listos:
+                try:
+                    cambiados |= _nombres_en_eventos(os.read(fd, 64 * 1024)) & nombres_observados
+                except BlockingIOError:
+                    pass
+                listos, _, _ = select.select([fd], [], [], ESPERA_AGRUPAR_CAMBIOS_SEGUNDOS)
+            if cambiados:
+                recargar_ahora(f"cambio en {', '.join(sorted(cambiados))}")
+    finally:
+        os.close(fd)
+
+
+def iniciar(rutas, funcion_carga, intervalo_sondeo=INTERVALO_SONDEO_SEGUNDOS):
+    """
+    Carga el estado inicial con 'funcion_carga' (que debe lanzar una excepción
+    si los archivos son inválidos) y arranca el hilo observador de 'rutas'.
+    Devuelve False si la carga inicial falla.
+    """
+    global _funcion_carga, _hilo_observador
+    _funcion_carga = funcion_carga
+    if not recargar_ahora("carga inicial"):
+        return False
+
+    rutas = [os.path.abspath(r) for r in rutas]
+    _detener.clear()
+    fd_inotify = _iniciar_inotify(sorted({os.path.dirname(r) for r in rutas}))
+    if fd_inotify is not None:
+        print(f"Recarga en caliente: observando {len(rutas)} archivos con inotify.")
+        objetivo, argumentos = _observar_con_inotify, (fd_inotify, rutas)
+    else:
+        print(f"Recarga en caliente: inotify no disponible, sondeo cada {intervalo_sondeo:.0f} s.")
+        objetivo, argumentos = _observar_por_sondeo, (rutas, intervalo_sondeo)
+    _hilo_observador = threading.Thread(target=objetivo, args=argumentos, name='recarga-en-caliente', daemon=True)
+    _hilo_observador.start()
+    return True
+
+
+def detener():
+    _detener.set()
+    if _hilo_observador is not None:
+        _hilo_observador.join(timeout=2)
@@ -1,20 +1,167 @@
-import requests
+import freshdesk_api
+import formato_cache
+import latencias
 import os
 import datetime
 import json
+import queue
+import threading
 
 # Tag a ser añadido a los tickets después de enviar la encuesta
 TAG_ENCUESTA_ENVIADA = "Encuesta enviada"
 
-# Las funciones _cargar_ids_procesados_encuestas y _guardar_id_procesado_encuesta
-# fueron eliminadas en versiones anteriores ya que no se usa el archivo local.
+DEFAULT_PER_PAGE_ASSUMPTION = 30 
+MAX_API_PAGES_TO_FETCH = 34 
+# Páginas descargadas por adelantado mientras se procesa la actual.
+PAGINAS_EN_ESPERA = 1
 
-def _obtener_tickets_cerrados_recientemente(fd_domain, fd_api_key, minutos_referencia_creacion):
+# Registro local de encuestas enviadas (archivos_estado.encuestas_procesadas).
+# Una línea por evento: ticket_id, fecha ISO (UTC) y estado. Permite saltear sin
+# consultar la API los tickets ya encuestados y deja un historial auditable.
+# Estados: la encuesta y el tag quedaron registrados, la encuesta se envió pero
+# falló la actualización del ticket, o el tag se encontró en Freshdesk sin
+# que figurara en el registro.
+REGISTRO_COMPLETA = 'completa'
+REGISTRO_SIN_TAG = 'sin_tag'
+REGISTRO_TAG_EXISTENTE = 'tag'
+DIAS_RETENCION_REGISTRO_DEFAULT = 7
+
+def _cargar_registro_encuestas(ruta_completa_archivo, dias_retencion):
+    """
+    Devuelve {ticket_id: (fecha_iso, estado)} con la última línea de cada ticket.
+    Las fechas sin zona horaria se toman como UTC. Las líneas mal formadas y las
+    entradas más viejas que 'dias_retencion' se descartan y, si hubo algo que
+    podar, el archivo se reescribe compacto (vía archivo temporal + rename).
+    """
+    registro = {}
+    if not os.path.exists(ruta_completa_archivo):
+        return registro
+    limite = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=dias_retencion)
+    lineas_leidas = 0
+    try:
+        # errors='replace': un byte dañado arruina solo su línea, no la lectura del resto.
+        with open(ruta_completa_archivo, "r", encoding='utf-8', errors='replace') as f:
+            for linea in f:
+                partes = linea.rstrip("\n").split("\t")
+                if not partes[0]:
+                    continue
+                lineas_leidas += 1
+                # Cada línea se valida por separado: una mal formada se descarta
+                # (y desaparece al compactar) sin perder las demás.
+                try:
+                    fecha = datetime.datetime.fromisoformat(partes[1])
+                    if fecha.tzinfo is None:
+                        fecha = fecha.replace(tzinfo=datetime.timezone.utc)
+                    if fecha < limite:
+                        continue
+                except (IndexError, TypeError, ValueError):
+                    continue
+                registro[partes[0]] = (partes[1], partes[2] if len(partes) > 2 else REGISTRO_COMPLETA)
+    except Exception as e:
+        print(f"Error cargando registro de encuestas '{ruta_completa_archivo}': {e}")
+        return registro
+
+    if lineas_leidas > len(registro):
+        ruta_temporal = f"{ruta_completa_archivo}.tmp"
+        try:
+            with open(ruta_temporal, "w", encoding='utf-8') as f:
+                for ticket_id, (fecha_iso, estado) in registro.items():
+                    f.write(f"{ticket_id}\t{fecha_iso}\t{estado}\n")
+            os.replace(ruta_temporal, ruta_completa_archivo)
+            print(f"Registro de encuestas compactado: {lineas_leidas} líneas -> {len(registro)} tickets.")
+        except Exception as e:
+            print(f"Advertencia: No se pudo compactar el registro de encuestas: {e}")
+    return registro
+
+def _registrar_encuesta(registro, ticket_id, estado, ruta_completa_archivo):
+    fecha_iso = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    registro[str(ticket_id)] = (fecha_iso, estado)
+    try:
+        with open(ruta_completa_archivo, "a", encoding='utf-8') as f:
+            f.write(f"{ticket_id}\t{fecha_iso}\t{estado}\n")
+    except Exception as e:
+        print(f"Error guardando ticket #{ticket_id} en el registro de encuestas: {e}")
+
+def _descargar_paginas_tickets_cerrados(url, fd_api_key, query_string, cola_paginas, detener, estado_etapa_api):
+    """
+    Productor del pipeline de búsqueda: descarga las páginas en orden y las deja
+    en 'cola_paginas' (acotada), de modo que la página N+1 se descarga mientras
+    se procesa la N. Siempre termina dejando None en la cola.
+    """
+    page_num = 1
+    total_descargados = 0
+    try:
+        with freshdesk_api.continuar_etapa(estado_etapa_api):
+            while page_num <= MAX_API_PAGES_TO_FETCH and not detener.is_set():
+                params = {
+                    'query': f'"{query_string}"',
+                    'page': page_num
+                }
+                response_obj = None
+                
+                print(f"Solicitando página {page_num} (tamaño de página por defecto, aprox. {DEFAULT_PER_PAGE_ASSUMPTION} tickets)...")
+                try:
+                    # Sin caché del ciclo: cada página se lee una sola vez y guardarla
+                    # anularía el límite de memoria del pipeline (PAGINAS_EN_ESPERA).
+                    response_obj = freshdesk_api.get(url, usar_cache=False, auth=(fd_api_key, 'x'), params=params)
+                    response_obj.raise_for_status() 
+                    data = response_obj.json()
+                    results_on_page = data.get('results', [])
+                    
+                    if not results_on_page:
+                        print(f"Página {page_num}: No se encontraron más tickets. Fin de la paginación.")
+                        break 
+                    
+                    total_descargados += len(results_on_page)
+                    print(f"Página {page_num}: Obtenidos {len(results_on_page)} tickets. Total acumulado: {total_descargados}.")
+                    if not _encolar_pagina(cola_paginas, results_on_page, detener):
+                        break
+                    
+                    if len(results_on_page) < DEFAULT_PER_PAGE_ASSUMPTION:
+                        print("Última página de resultados alcanzada (o menos tickets que el default por página).")
+                        break
+                    
+                    page_num += 1
+                    
+                except freshdesk_api.HTTPError as http_err:
+                    error_msg = f"Error HTTP (encuestas - API filter created_at:'YYYY-MM-DD', pág {page_num}): {http_err}"
+                    if response_obj and hasattr(response_obj, 'text'):
+                        error_msg += f"\nServer: {response_obj.text}"
+                    print(error_msg)
+                    break 
+                except Exception as e:
+                    print(f"Error (encuestas - API filter created_at:'YYYY-MM-DD', pág {page_num}): {e}")
+                    break
+                    
+        if page_num > MAX_API_PAGES_TO_FETCH and total_descargados >= MAX_API_PAGES_TO_FETCH * DEFAULT_PER_PAGE_ASSUMPTION:
+            print(f"ADVERTENCIA: Se alcanzó el límite de {MAX_API_PAGES_TO_FETCH} páginas. "
+                  "Podría haber más tickets que no se recuperaron debido al límite de la API de búsqueda (aprox. 1000 tickets).")
+    finally:
+        _encolar_pagina(cola_paginas, None, detener)
+
+
+def _encolar_pagina(cola_paginas, pagina, detener):
+    # Espera lugar en la cola sin quedar bloqueado si el consumidor ya abandonó.
+    while not detener.is_set():
+        try:
+            cola_paginas.put(pagina, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _obtener_tickets_cerrados_recientemente(fd_domain, fd_api_key, minutos_referencia_creacion, fecha_llegada=None):
     """
     Busca tickets cerrados (estados 5, 6, 7) CREADOS EN EL DÍA CALENDARIO
     de hace X minutos, utilizando el filtro de fecha de la API de Freshdesk
     (created_at:'YYYY-MM-DD'). Implementa paginación usando el tamaño de página
     predeterminado de la API (normalmente 30) para obtener hasta 1000 resultados.
+
+    Es un generador: entrega los tickets a medida que llegan las páginas, con
+    la página siguiente descargándose en segundo plano. En memoria hay como
+    máximo PAGINAS_EN_ESPERA páginas además de la que se está procesando.
+    fecha_llegada(ticket) da la fecha con la que el planificador cuenta llegadas.
     """
     url = f"https://{fd_domain}.freshdesk.com/api/v2/search/tickets"
     
@@ -26,92 +173,73 @@ def _obtener_tickets_cerrados_recientemente(fd_domain, fd_api_key, minutos_refer
     
     print(f"Intentando búsqueda en API Freshdesk con query: {query_string}")
     print(f"(Esto buscará tickets creados EN EL DÍA {fecha_limite_str} con los estados indicados)")
-    
-    all_results_from_api = []
-    page_num = 1
-    DEFAULT_PER_PAGE_ASSUMPTION = 30 
-    MAX_API_PAGES_TO_FETCH = 34 
-
-    while page_num <= MAX_API_PAGES_TO_FETCH:
-        params = {
-            'query': f'"{query_string}"',
-            'page': page_num
-        }
-        response_obj = None
-        
-        print(f"Solicitando página {page_num} (tamaño de página por defecto, aprox. {DEFAULT_PER_PAGE_ASSUMPTION} tickets)...")
-        try:
-            response_obj = requests.get(url, auth=(fd_api_key, 'x'), params=params)
-            response_obj.raise_for_status() 
-            data = response_obj.json()
-            results_on_page = data.get('results', [])
-            
-            if not results_on_page:
-                print(f"Página {page_num}: No se encontraron más tickets. Fin de la paginación.")
-                break 
-            
-            all_results_from_api.extend(results_on_page)
-            print(f"Página {page_num}: Obtenidos {len(results_on_page)} tickets. Total acumulado: {len(all_results_from_api)}.")
-            
-            if len(results_on_page) < DEFAULT_PER_PAGE_ASSUMPTION:
-                print("Última página de resultados alcanzada (o menos tickets que el default por página).")
-                break
-            
-            page_num += 1
-            
-        except requests.exceptions.HTTPError as http_err:
-            error_msg = f"Error HTTP (encuestas - API filter created_at:'YYYY-MM-DD', pág {page_num}): {http_err}"
-            if response_obj and hasattr(response_obj, 'text'):
-                error_msg += f"\nServer: {response_obj.text}"
-            print(error_msg)
-            break 
-        except Exception as e:
-            print(f"Error (encuestas - API filter created_at:'YYYY-MM-DD', pág {page_num}): {e}")
-            break
-            
-    if page_num > MAX_API_PAGES_TO_FETCH and len(all_results_from_api) >= MAX_API_PAGES_TO_FETCH * DEFAULT_PER_PAGE_ASSUMPTION:
-        print(f"ADVERTENCIA: Se alcanzó el límite de {MAX_API_PAGES_TO_FETCH} páginas. "
-              "Podría haber más tickets que no se recuperaron debido al límite de la API de búsqueda (aprox. 1000 tickets).")
 
-    print(f"Total de tickets recuperados de la API después de paginación: {len(all_results_from_api)}.")
-    return all_results_from_api
+    cola_paginas = queue.Queue(maxsize=PAGINAS_EN_ESPERA)
+    detener = threading.Event()
+    hilo_descarga = threading.Thread(
+        target=_descargar_paginas_tickets_cerrados,
+        args=(url, fd_api_key, query_string, cola_paginas, detener, freshdesk_api.etapa_actual()),
+        name='encuestas-paginas',
+        daemon=True
+    )
+    hilo_descarga.start()
+
+    total_entregados = 0
+    try:
+        while True:
+            pagina = cola_paginas.get()
+            if pagina is None:
+                break
+            total_entregados += len(pagina)
+            freshdesk_api.registrar_tickets_encontrados(pagina, fecha_llegada or _fecha_cierre)
+            yield from pagina
+        print(f"Total de tickets recuperados de la API después de paginación: {total_entregados}.")
+    finally:
+        detener.set()
 
 
 def _obtener_detalles_ticket_fd(fd_domain, fd_api_key, ticket_id):
     url = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}"
     response_obj = None
     try:
-        response_obj = requests.get(url, auth=(fd_api_key, 'x'))
+        response_obj = freshdesk_api.get(url, auth=(fd_api_key, 'x'))
         response_obj.raise_for_status()
         return response_obj.json() 
-    except requests.exceptions.HTTPError as http_err:
+    except freshdesk_api.HTTPError as http_err:
         error_msg = f"Error HTTP obteniendo detalles del ticket #{ticket_id}: {http_err}"
         if response_obj and hasattr(response_obj, 'text'):
             error_msg += f"\nServer: {response_obj.text}"
         print(error_msg)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e:
         print(f"Error obteniendo detalles del ticket #{ticket_id}: {e}")
     return None
 
-def _enviar_mensaje_y_actualizar_ticket_fd(fd_domain, fd_api_key, ticket_id, mensaje_body, original_agent_id, original_status, tags_previos_al_envio):
+def _enviar_mensaje_encuesta_fd(fd_domain, fd_api_key, ticket_id, mensaje_body):
     url_reply = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}/reply"
     headers_reply = {"Content-Type": "application/json"}
     data_reply = {"body": mensaje_body}
     response_obj_reply = None
     try:
-        response_obj_reply = requests.post(url_reply, auth=(fd_api_key, 'x'), headers=headers_reply, json=data_reply)
+        response_obj_reply = freshdesk_api.post(url_reply, auth=(fd_api_key, 'x'), headers=headers_reply, json=data_reply)
         response_obj_reply.raise_for_status()
         print(f"✅ Mensaje de encuesta enviado al ticket #{ticket_id}.")
-    except requests.exceptions.HTTPError as http_err_reply:
+    except freshdesk_api.HTTPError as http_err_reply:
         error_msg_reply = f"❌ Error HTTP enviando mensaje encuesta al ticket #{ticket_id}: {http_err_reply}"
         if response_obj_reply and hasattr(response_obj_reply, 'text'):
             error_msg_reply += f"\nServer: {response_obj_reply.text}"
         print(error_msg_reply)
         return False 
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e_reply:
         print(f"❌ Error enviando mensaje encuesta al ticket #{ticket_id}: {e_reply}")
         return False
+    return True
 
+def _actualizar_ticket_post_encuesta_fd(fd_domain, fd_api_key, ticket_id, original_agent_id, original_status, tags_previos_al_envio):
+    # Restaura estado y agente (la respuesta puede reabrir el ticket) y agrega el tag de encuesta.
     url_update = f"https://{fd_domain}.freshdesk.com/api/v2/tickets/{ticket_id}"
     tags_para_actualizar = list(tags_previos_al_envio) 
     if TAG_ENCUESTA_ENVIADA not in tags_para_actualizar:
@@ -123,19 +251,27 @@ def _enviar_mensaje_y_actualizar_ticket_fd(fd_domain, fd_api_key, ticket_id, men
     }
     response_obj_update = None
     try:
-        response_obj_update = requests.put(url_update, auth=(fd_api_key, 'x'), json=data_update)
+        response_obj_update = freshdesk_api.put(url_update, auth=(fd_api_key, 'x'), json=data_update)
         response_obj_update.raise_for_status()
         print(f"✅ Ticket #{ticket_id} actualizado: Estado original ({original_status}), Agente original ({original_agent_id}), Tag '{TAG_ENCUESTA_ENVIADA}' agregado/confirmado.")
         return True
-    except requests.exceptions.HTTPError as http_err_update:
+    except freshdesk_api.HTTPError as http_err_update:
         error_msg_update = f"❌ Error HTTP actualizando ticket #{ticket_id} post-encuesta: {http_err_update}"
         if response_obj_update and hasattr(response_obj_update, 'text'):
             error_msg_update += f"\nServer: {response_obj_update.text}"
         print(error_msg_update)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e_update:
         print(f"❌ Error actualizando ticket #{ticket_id} post-encuesta: {e_update}")
     return False
 
+def _fecha_cierre(ticket):
+    # stats solo viene si se pide include=stats (cuesta créditos de API); sin él,
+    # updated_at antes de enviar la encuesta es la hora del cierre en la práctica.
+    stats = ticket.get('stats') or {}
+    return stats.get('closed_at') or stats.get('resolved_at') or ticket.get('updated_at')
+
 def ejecutar_proceso_encuestas(
     fd_config, 
     plantilla_mensaje_cierre, 
@@ -150,30 +286,46 @@ def ejecutar_proceso_encuestas(
     fd_domain = fd_config.get('domain')
         
     minutos_para_referencia_creacion = 240 
+    ruta_registro_encuestas = os.path.join(script_dir, archivos_estado_config.get('encuestas_procesadas', 'encuestas_procesadas_ids.txt'))
+    dias_retencion_registro = params_app_config.get('dias_retencion_registro_encuestas', DIAS_RETENCION_REGISTRO_DEFAULT)
 
     if not all([fd_api_key, fd_domain, plantilla_mensaje_cierre]):
         print("Error (Encuestas): Faltan configuraciones esenciales.")
         print("--- Proceso de Envío de Encuestas Finalizado ---")
-        return
+        return 0
+
+    registro_encuestas = _cargar_registro_encuestas(ruta_registro_encuestas, dias_retencion_registro)
+
+    def _fecha_llegada(ticket):
+        # La búsqueda devuelve todos los cerrados del día: los que ya están en el
+        # registro no son llegadas nuevas aunque su updated_at haya cambiado.
+        if str(ticket['id']) in registro_encuestas:
+            return None
+        return _fecha_cierre(ticket)
 
     tickets_para_procesar = _obtener_tickets_cerrados_recientemente(
         fd_domain, 
         fd_api_key,
-        minutos_para_referencia_creacion
+        minutos_para_referencia_creacion,
+        _fecha_llegada
     )
 
-    if not tickets_para_procesar:
-        print("No se encontraron tickets (según filtro API por DÍA de creación y estado) para enviar encuesta.")
-        print("--- Proceso de Envío de Encuestas Finalizado ---")
-        return
-
     procesados_en_esta_ejecucion = 0
+    tickets_vistos = 0
+    omitidos_por_registro = 0
     for ticket_info in tickets_para_procesar:
+        tickets_vistos += 1
         ticket_id_actual_str = str(ticket_info['id'])
+
+        estado_registro = registro_encuestas.get(ticket_id_actual_str, (None, None))[1]
+        if estado_registro in (REGISTRO_COMPLETA, REGISTRO_TAG_EXISTENTE):
+            omitidos_por_registro += 1
+            continue
         
         tags_en_resumen = ticket_info.get('tags', [])
         if TAG_ENCUESTA_ENVIADA in tags_en_resumen:
             print(f"Ticket #{ticket_id_actual_str} ya tiene el tag '{TAG_ENCUESTA_ENVIADA}' (detectado en resultado de API). Omitiendo.")
+            _registrar_encuesta(registro_encuestas, ticket_id_actual_str, REGISTRO_TAG_EXISTENTE, ruta_registro_encuestas)
             continue
         
         print(f"\nProcesando ticket #{ticket_id_actual_str} para envío de encuesta...")
@@ -193,6 +345,15 @@ def ejecutar_proceso_encuestas(
 
         if TAG_ENCUESTA_ENVIADA in tags_actuales_del_ticket:
             print(f"Ticket #{ticket_id_actual_str} ya tiene el tag '{TAG_ENCUESTA_ENVIADA}' (detectado en detalles completos). Omitiendo.")
+            _registrar_encuesta(registro_encuestas, ticket_id_actual_str, REGISTRO_TAG_EXISTENTE, ruta_registro_encuestas)
+            continue
+
+        if estado_registro == REGISTRO_SIN_TAG:
+            # La encuesta ya se envió en una ejecución anterior: solo falta actualizar el ticket.
+            print(f"Ticket #{ticket_id_actual_str}: encuesta ya enviada según el registro local. Reintentando solo la actualización.")
+            if _actualizar_ticket_post_encuesta_fd(fd_domain, fd_api_key, ticket_id_actual_str,
+                                                   original_responder_id, original_status, tags_actuales_del_ticket):
+                _registrar_encuesta(registro_encuestas, ticket_id_actual_str, REGISTRO_COMPLETA, ruta_registro_encuestas)
             continue
 
         agent_id_str = str(original_responder_id) if original_responder_id is not None else None
@@ -219,25 +380,43 @@ def ejecutar_proceso_encuestas(
             print(f"Error al formatear plantilla de encuesta para ticket #{ticket_id_actual_str}: Falta la clave {e}. Usando plantilla sin formato.")
             mensaje_formateado = plantilla_mensaje_cierre 
 
-        if _enviar_mensaje_y_actualizar_ticket_fd(
-            fd_domain, 
-            fd_api_key, 
-            ticket_id_actual_str, 
-            mensaje_formateado, 
-            original_responder_id, 
-            original_status,
-            tags_actuales_del_ticket 
-        ):
+        if not _enviar_mensaje_encuesta_fd(fd_domain, fd_api_key, ticket_id_actual_str, mensaje_formateado):
+            print(f"Hubo un problema al procesar el ticket #{ticket_id_actual_str} para encuesta.")
+            continue
+        latencias.registrar('encuesta', ticket_id_actual_str, _fecha_cierre(ticket_detalles_completos), original_responder_id)
+        # Con la encuesta ya enviada, el tag se agrega aunque se haya agotado el plazo de la etapa.
+        with freshdesk_api.sin_plazo():
+            actualizado = _actualizar_ticket_post_encuesta_fd(
+                fd_domain, 
+                fd_api_key, 
+                ticket_id_actual_str, 
+                original_responder_id, 
+                original_status,
+                tags_actuales_del_ticket 
+            )
+        if actualizado:
+            _registrar_encuesta(registro_encuestas, ticket_id_actual_str, REGISTRO_COMPLETA, ruta_registro_encuestas)
             procesados_en_esta_ejecucion += 1
         else:
+            # Se registra igual para no enviar la encuesta dos veces; el tag se reintenta en la próxima ejecución.
+            _registrar_encuesta(registro_encuestas, ticket_id_actual_str, REGISTRO_SIN_TAG, ruta_registro_encuestas)
             print(f"Hubo un problema al procesar el ticket #{ticket_id_actual_str} para encuesta.")
         
+    if omitidos_por_registro:
+        print(f"{omitidos_por_registro} tickets omitidos sin consultar la API (ya figuran en el registro local de encuestas).")
+
+    if tickets_vistos == 0:
+        print("No se encontraron tickets (según filtro API por DÍA de creación y estado) para enviar encuesta.")
+        print("--- Proceso de Envío de Encuestas Finalizado ---")
+        return 0
+
     if procesados_en_esta_ejecucion > 0:
         print(f"Se procesaron {procesados_en_esta_ejecucion} tickets para envío de encuesta.")
     else:
         print("No hubo nuevos tickets (que no tuvieran ya encuesta enviada y cumplieran filtro API) para procesar en esta ejecución.")
     
     print("--- Proceso de Envío de Encuestas Finalizado ---")
+    return procesados_en_esta_ejecucion
 
 if __name__ == "__main__":
     print("Ejecutando prueba local de survey_sender.py...")
@@ -255,8 +434,8 @@ if __name__ == "__main__":
 
     try:
         with open(mock_config_path, 'r', encoding='utf-8') as f: config_principal = json.load(f)
-        with open(mock_cache_config_global_path, 'r', encoding='utf-8') as f: configuracion_global_cache = json.load(f)
-        with open(mock_cache_mapa_agentes_path, 'r', encoding='utf-8') as f: mapa_agentes_cache = json.load(f)
+        configuracion_global_cache = formato_cache.leer_cache(mock_cache_config_global_path)
+        mapa_agentes_cache = formato_cache.leer_cache(mock_cache_mapa_agentes_path)
     except Exception as e:
         print(f"Error cargando archivos de configuración/caché para prueba: {e}")
         exit()
@@ -0,0 +1,301 @@
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import freshdesk_api
+
+# Pruebas de la caché de lecturas (coalescencia e invalidación) y del reparto
+# del límite de solicitudes. No salen a la red: se reemplaza _solicitar y, para
+# las cubetas, el reloj del módulo.
+
+URL_TICKET_5 = "https://d.freshdesk.com/api/v2/tickets/5"
+URL_TICKET_6 = "https://d.freshdesk.com/api/v2/tickets/6"
+URL_BUSQUEDA = "https://d.freshdesk.com/api/v2/search/tickets"
+
+
+class RespuestaFalsa:
+    def __init__(self, valor, ok=True, headers=None):
+        self.valor = valor
+        self.ok = ok
+        self.status_code = 200 if ok else 500
+        self.headers = headers or {}
+
+
+class SolicitudesFalsas:
+    """Reemplazo de _solicitar: cuenta las llamadas y puede frenar los GET hasta que se lo libere."""
+
+    def __init__(self, frenar_get=False):
+        self.llamadas = []
+        self.valor = 1
+        self.ok = True
+        self.error = None
+        self.en_curso = threading.Event()
+        self.liberar = threading.Event()
+        if not frenar_get:
+            self.liberar.set()
+
+    def __call__(self, metodo, url, **kwargs):
+        self.llamadas.append((metodo, url))
+        if metodo != 'GET':
+            self.valor += 1
+            return RespuestaFalsa(None)
+        valor = self.valor
+        self.en_curso.set()
+        self.liberar.wait(5)
+        if self.error is not None:
+            raise self.error
+        return RespuestaFalsa(valor, ok=self.ok)
+
+    def gets(self):
+        return sum(1 for metodo, _ in self.llamadas if metodo == 'GET')
+
+
+class RelojFalso:
+    def __init__(self):
+        self.ahora = 1000.0
+        self.esperas = []
+
+    def monotonic(self):
+        return self.ahora
+
+    def perf_counter(self):
+        return self.ahora
+
+    def sleep(self, segundos):
+        self.esperas.append(segundos)
+        self.ahora += segundos
+
+
+def _en_hilo(funcion, resultados, clave):
+    hilo = threading.Thread(target=lambda: resultados.__setitem__(clave, funcion()))
+    hilo.start()
+    return hilo
+
+
+class TestCacheLecturas(unittest.TestCase):
+
+    def setUp(self):
+        freshdesk_api.iniciar_ciclo(True)
+
+    def tearDown(self):
+        freshdesk_api.iniciar_ciclo(True)
+
+    def test_lecturas_repetidas_salen_una_vez(self):
+        falsas = SolicitudesFalsas()
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            primera = freshdesk_api.get(URL_TICKET_5)
+            segunda = freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_5, usar_cache=False)
+        self.assertIs(primera, segunda)
+        self.assertEqual(falsas.gets(), 2)
+
+    def test_parametros_distintos_son_lecturas_distintas(self):
+        falsas = SolicitudesFalsas()
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            freshdesk_api.get(URL_BUSQUEDA, params={'query': 'a', 'page': 2})
+            freshdesk_api.get(URL_BUSQUEDA, params={'page': 2, 'query': 'a'})
+            freshdesk_api.get(URL_BUSQUEDA, params={'query': 'a', 'page': 3})
+        self.assertEqual(falsas.gets(), 2)
+
+    def test_cache_desactivada(self):
+        freshdesk_api.iniciar_ciclo(False)
+        falsas = SolicitudesFalsas()
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_5)
+        self.assertEqual(falsas.gets(), 2)
+
+    def test_respuesta_con_error_no_queda_en_cache(self):
+        falsas = SolicitudesFalsas()
+        falsas.ok = False
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_5)
+        self.assertEqual(falsas.gets(), 2)
+
+    def test_lecturas_simultaneas_se_coalescen(self):
+        falsas = SolicitudesFalsas(frenar_get=True)
+        resultados = {}
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            with freshdesk_api.etapa('encuestas') as estado_etapa:
+                def leer_en_la_etapa():
+                    with freshdesk_api.continuar_etapa(estado_etapa):
+                        return freshdesk_api.get(URL_TICKET_5)
+
+                lider = _en_hilo(leer_en_la_etapa, resultados, 'lider')
+                self.assertTrue(falsas.en_curso.wait(5))
+                espera = _en_hilo(leer_en_la_etapa, resultados, 'espera')
+                falsas.liberar.set()
+                lider.join(5)
+                espera.join(5)
+        self.assertEqual(falsas.gets(), 1)
+        self.assertIs(resultados['lider'], resultados['espera'])
+        self.assertEqual(estado_etapa["lecturas_en_cache"], 1)
+
+    def test_espera_reintenta_si_el_lider_falla(self):
+        falsas = SolicitudesFalsas(frenar_get=True)
+        falsas.error = ConnectionError("sin red")
+        resultados = {}
+
+        def leer():
+            try:
+                return freshdesk_api.get(URL_TICKET_5)
+            except ConnectionError as e:
+                return e
+
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            lider = _en_hilo(leer, resultados, 'lider')
+            self.assertTrue(falsas.en_curso.wait(5))
+            espera = _en_hilo(leer, resultados, 'espera')
+            falsas.liberar.set()
+            lider.join(5)
+            espera.join(5)
+        self.assertIsInstance(resultados['lider'], ConnectionError)
+        self.assertIsInstance(resultados['espera'], ConnectionError)
+        self.assertEqual(falsas.gets(), 2)
+        self.assertNotIn(URL_TICKET_5 + '?', freshdesk_api._lecturas)
+
+    def test_escritura_invalida_el_ticket_y_las_busquedas(self):
+        falsas = SolicitudesFalsas()
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_6)
+            freshdesk_api.get(URL_BUSQUEDA, params={'query': 'a'})
+            freshdesk_api.put(URL_TICKET_5, json={})
+            self.assertEqual(freshdesk_api.get(URL_TICKET_5).valor, 2)
+            self.assertEqual(freshdesk_api.get(URL_TICKET_6).valor, 1)
+            freshdesk_api.get(URL_BUSQUEDA, params={'query': 'a'})
+        self.assertEqual(falsas.gets(), 5)
+
+    def test_escritura_sin_id_invalida_todo(self):
+        falsas = SolicitudesFalsas()
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_6)
+            freshdesk_api.post("https://d.freshdesk.com/api/v2/tickets/bulk_update", json={})
+            freshdesk_api.get(URL_TICKET_5)
+            freshdesk_api.get(URL_TICKET_6)
+        self.assertEqual(falsas.gets(), 4)
+
+    def test_lectura_en_curso_durante_escritura_se_descarta(self):
+        falsas = SolicitudesFalsas(frenar_get=True)
+        resultados = {}
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            lider = _en_hilo(lambda: freshdesk_api.get(URL_TICKET_5), resultados, 'lider')
+            self.assertTrue(falsas.en_curso.wait(5))
+            espera = _en_hilo(lambda: freshdesk_api.get(URL_TICKET_5), resultados, 'espera')
+            freshdesk_api.put(URL_TICKET_5, json={})
+            falsas.liberar.set()
+            lider.join(5)
+            espera.join(5)
+            posterior = freshdesk_api.get(URL_TICKET_5)
+        # El líder devuelve lo que leyó, pero no se comparte ni se guarda.
+        self.assertEqual(resultados['lider'].valor, 1)
+        self.assertEqual(resultados['espera'].valor, 2)
+        self.assertEqual(posterior.valor, 2)
+
+    def test_lectura_en_curso_de_otro_ticket_se_guarda(self):
+        falsas = SolicitudesFalsas(frenar_get=True)
+        resultados = {}
+        with mock.patch.object(freshdesk_api, '_solicitar', falsas):
+            lider = _en_hilo(lambda: freshdesk_api.get(URL_TICKET_6), resultados, 'lider')
+            self.assertTrue(falsas.en_curso.wait(5))
+            freshdesk_api.put(URL_TICKET_5, json={})
+            falsas.liberar.set()
+            lider.join(5)
+            self.assertIs(freshdesk_api.get(URL_TICKET_6), resultados['lider'])
+        self.assertEqual(falsas.gets(), 1)
+
+
+class TestLimiteSolicitudes(unittest.TestCase):
+
+    def setUp(self):
+        self.reloj = RelojFalso()
+        self.parche = mock.patch.object(freshdesk_api, 'time', self.reloj)
+        self.parche.start()
+        freshdesk_api._bloqueado_hasta = 0.0
+
+    def tearDown(self):
+        freshdesk_api.configurar_limite(None)
+        freshdesk_api._bloqueado_hasta = 0.0
+        self.parche.stop()
+
+    def _vaciar(self, nombre_etapa):
+        freshdesk_api._cubetas[nombre_etapa]["tokens"] = 0.0
+
+    def test_orden_reservado_comun_prestado(self):
+        freshdesk_api.configurar_limite(60, {'asignaciones': 0.5, 'fuera_horario': 0.25})
+        self.assertEqual(freshdesk_api._tomar_cupo('asignaciones'), "reservado")
+        self._vaciar('asignaciones')
+        self.assertEqual(freshdesk_api._tomar_cupo('asignaciones'), "comun")
+        self._vaciar(None)
+        # fuera_horario está llena: su cupo se perdería, se puede tomar prestado.
+        self.assertEqual(freshdesk_api._tomar_cupo('asignaciones'), "prestado")
+        # Ya no está llena: no se le vuelve a tomar.
+        self.assertIsInstance(freshdesk_api._tomar_cupo('asignaciones'), float)
+
+    def test_etapa_sin_reserva_no_vacia_las_reservas(self):
+        freshdesk_api.configurar_limite(60, {'asignaciones': 0.5})
+        self._vaciar(None)
+        self.assertEqual(freshdesk_api._tomar_cupo('encuestas'), "prestado")
+        espera = freshdesk_api._tomar_cupo('encuestas')
+        self.assertIsInstance(espera, float)
+        self.assertGreater(espera, 0)
+        self.assertGreaterEqual(freshdesk_api._cubetas['asignaciones']["tokens"], 29)
+
+    def test_espera_hasta_recargar(self):
+        freshdesk_api.configurar_limite(60)
+        self._vaciar(None)
+        with freshdesk_api.etapa('encuestas') as estado_etapa:
+            freshdesk_api._esperar_turno(estado_etapa)
+        self.assertAlmostEqual(sum(self.reloj.esperas), 1.0)
+        self.assertEqual(estado_etapa["cupo"]["comun"], 1)
+        self.assertAlmostEqual(estado_etapa["espera_cupo"], 1.0)
+
+    def test_sin_limite_no_espera(self):
+        freshdesk_api.configurar_limite(None)
+        with freshdesk_api.etapa('encuestas') as estado_etapa:
+            for _ in range(100):
+                freshdesk_api._esperar_turno(estado_etapa)
+        self.assertEqual(self.reloj.esperas, [])
+
+    def test_429_frena_y_vacia_las_cubetas(self):
+        freshdesk_api.configurar_limite(60, {'asignaciones': 0.5})
+        with mock.patch('builtins.print'):
+            freshdesk_api._registrar_limite_excedido(RespuestaFalsa(None, headers={'Retry-After': '10'}))
+        self.assertTrue(all(cubeta["tokens"] == 0 for cubeta in freshdesk_api._cubetas.values()))
+        with freshdesk_api.etapa('asignaciones') as estado_etapa:
+            freshdesk_api._esperar_turno(estado_etapa)
+        self.assertGreaterEqual(self.reloj.ahora, 1010.0)
+
+    def test_retry_after_acotado(self):
+        freshdesk_api.configurar_limite(60)
+        with mock.patch('builtins.print'):
+            freshdesk_api._registrar_limite_excedido(RespuestaFalsa(None, headers={'Retry-After': '3600'}))
+        self.assertEqual(freshdesk_api._bloqueado_hasta, 1000.0 + freshdesk_api.MAX_ESPERA_RETRY_AFTER_SEGUNDOS)
+
+    def test_espera_mas_larga_que_el_plazo_corta_la_etapa(self):
+        freshdesk_api.configurar_limite(6)
+        self._vaciar(None)
+        with freshdesk_api.etapa('encuestas', timeout_segundos=2) as estado_etapa:
+            with self.assertRaises(freshdesk_api.TiempoEtapaAgotado):
+                freshdesk_api._esperar_turno(estado_etapa)
+        self.assertTrue(estado_etapa["tiempo_agotado"])
+        self.assertEqual(self.reloj.esperas, [])
+
+    def test_sin_plazo_ignora_el_tiempo_agotado(self):
+        freshdesk_api.configurar_limite(6)
+        self._vaciar(None)
+        with freshdesk_api.etapa('encuestas', timeout_segundos=2) as estado_etapa:
+            with freshdesk_api.sin_plazo():
+                freshdesk_api._esperar_turno(estado_etapa)
+        self.assertFalse(estado_etapa["tiempo_agotado"])
+        self.assertAlmostEqual(sum(self.reloj.esperas), 10.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
-import requests
+import freshdesk_api
+import fuera_horario
+import prioridad_tickets
+import latencias
 import os
 
 # Constante para el estado "Abierto" en Freshdesk es 2
@@ -8,22 +11,20 @@ import os
 
 
 def _obtener_tickets_pendientes_fd(domain, api_key):
-    url = f"https://{domain}.freshdesk.com/api/v2/search/tickets"
-    # Buscar tickets que están en estado Pendiente (3) y no tienen agente asignado
+    # Buscar tickets que están en estado Pendiente (3) y no tienen agente asignado.
+    # Se traen todas las páginas para que el orden por prioridad/SLA vea todo el backlog.
+    # Un error de búsqueda se propaga: la etapa no debe figurar como exitosa.
     query_string = f'status:3 AND agent_id:null' 
-    params = {'query': f'"{query_string}"'}
-    response_obj = None
     try:
-        response_obj = requests.get(url, auth=(api_key, 'x'), params=params)
-        response_obj.raise_for_status()
-        data = response_obj.json()
-        return data.get('results', [])
-    except requests.exceptions.HTTPError as http_err:
+        return freshdesk_api.buscar_tickets(domain, api_key, query_string)
+    except freshdesk_api.HTTPError as http_err:
         error_msg = f"Error HTTP (obtener pendientes): {http_err}"
-        if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
+        if http_err.response is not None: error_msg += f"\nServer: {http_err.response.text}"
         print(error_msg)
-    except Exception as e: print(f"Error (obtener pendientes): {e}")
-    return []
+        raise
+    except Exception as e:
+        print(f"Error (obtener pendientes): {e}")
+        raise
 
 def _asignar_y_abrir_ticket_fd(domain, api_key, ticket_id, agente_id):
     """
@@ -37,14 +38,16 @@ def _asignar_y_abrir_ticket_fd(domain, api_key, ticket_id, agente_id):
     }
     response_obj = None
     try:
-        response_obj = requests.put(url, auth=(api_key, 'x'), json=data)
+        response_obj = freshdesk_api.put(url, auth=(api_key, 'x'), json=data)
         response_obj.raise_for_status()
         print(f"Ticket #{ticket_id} asignado a agente ID {agente_id} y estado cambiado a Abierto.")
         return True
-    except requests.exceptions.HTTPError as http_err:
+    except freshdesk_api.HTTPError as http_err:
         error_msg = f"Error HTTP asignando/abriendo ticket #{ticket_id}: {http_err}"
         if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
         print(error_msg)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e: print(f"Error asignando/abriendo ticket #{ticket_id}: {e}")
     return False
 
@@ -54,27 +57,21 @@ def _enviar_respuesta_fd(domain, api_key, ticket_id, mensaje_body):
     data = {"body": mensaje_body}
     response_obj = None
     try:
-        response_obj = requests.post(url, auth=(api_key, 'x'), headers=headers, json=data)
+        response_obj = freshdesk_api.post(url, auth=(api_key, 'x'), headers=headers, json=data)
         response_obj.raise_for_status()
         print(f"✅ Respuesta de apertura enviada al ticket #{ticket_id}.")
         return True
-    except requests.exceptions.HTTPError as http_err:
+    except freshdesk_api.HTTPError as http_err:
         error_msg = f"❌ Error HTTP enviando respuesta apertura {ticket_id}: {http_err}"
         if response_obj and hasattr(response_obj, 'text'): error_msg += f"\nServer: {response_obj.text}"
         print(error_msg)
+    except freshdesk_api.TiempoEtapaAgotado:
+        raise
     except Exception as e: print(f"❌ Error enviando respuesta apertura {ticket_id}: {e}")
     return False
 
-def _obtener_siguiente_agente_id_rotacion(agentes_operativos_ids_list, archivo_ultimo_agente_path):
-    if not agentes_operativos_ids_list: return None 
-    ultimo_id_guardado = None # Iniciar como None
-    try:
-        if os.path.exists(archivo_ultimo_agente_path):
-            with open(archivo_ultimo_agente_path, "r", encoding='utf-8') as f:
-                contenido = f.read().strip()
-                if contenido: ultimo_id_guardado = str(contenido) 
-    except Exception as e_read: print(f"Advertencia: No se pudo leer {archivo_ultimo_agente_path}. Error: {e_read}")
-    
+def _siguiente_agente_en_rotacion(agentes_operativos_ids_list, ultimo_id_guardado):
+    # Parte sin E/S de la rotación: el agente que sigue al último asignado (o el primero).
     siguiente_index = 0
     agentes_operativos_str_ids = [str(ag_id) for ag_id in agentes_operativos_ids_list]
 
@@ -85,7 +82,19 @@ def _obtener_siguiente_agente_id_rotacion(agentes_operativos_ids_list, archivo_u
     
     if not agentes_operativos_str_ids: return None 
     
-    siguiente_agente_id = agentes_operativos_str_ids[siguiente_index]
+    return agentes_operativos_str_ids[siguiente_index]
+
+def _obtener_siguiente_agente_id_rotacion(agentes_operativos_ids_list, archivo_ultimo_agente_path):
+    if not agentes_operativos_ids_list: return None 
+    ultimo_id_guardado = None # Iniciar como None
+    try:
+        if os.path.exists(archivo_ultimo_agente_path):
+            with open(archivo_ultimo_agente_path, "r", encoding='utf-8') as f:
+                contenido = f.read().strip()
+                if contenido: ultimo_id_guardado = str(contenido) 
+    except Exception as e_read: print(f"Advertencia: No se pudo leer {archivo_ultimo_agente_path}. Error: {e_read}")
+    
+    siguiente_agente_id = _siguiente_agente_en_rotacion(agentes_operativos_ids_list, ultimo_id_guardado)
     try:
         with open(archivo_ultimo_agente_path, "w", encoding='utf-8') as f: f.write(str(siguiente_agente_id))
     except IOError as e_write: print(f"Advertencia: No se pudo escribir en {archivo_ultimo_agente_path}. Error: {e_write}")
@@ -99,35 +108,42 @@ def ejecutar_proceso_asignaciones(
     archivos_estado_config, 
     script_dir, 
     mapa_agentes_cache, 
-    agentes_operativos_cache 
+    agentes_operativos_cache,
+    params_app_config=None
 ):
     print("--- Iniciando Proceso de Asignación y Saludo de Apertura ---")
     
     api_key = fd_config.get('api_key')
     domain = fd_config.get('domain')
     ruta_ultimo_agente = os.path.join(script_dir, archivos_estado_config.get('ultimo_agente_asignado'))
+    params_app_config = params_app_config or {}
+    max_tickets_por_ciclo = params_app_config.get('max_tickets_por_ciclo', {}).get('asignaciones')
+    minutos_urgencia_sla = params_app_config.get('minutos_urgencia_sla', prioridad_tickets.MINUTOS_URGENCIA_SLA_DEFAULT)
 
     if not all([api_key, domain, plantilla_saludo_apertura, ruta_ultimo_agente]):
         print("Error (Asignación): Faltan configuraciones esenciales.")
-        return
+        return 0
 
     if not agentes_operativos_cache:
         print("No hay agentes operativos disponibles. No se asignarán tickets.")
         print("--- Proceso de Asignación y Saludo de Apertura Finalizado ---")
-        return
+        return 0
 
     tickets_para_procesar = _obtener_tickets_pendientes_fd(domain, api_key)
     if not tickets_para_procesar:
         print("No hay tickets pendientes (status 3) para asignar.")
         print("--- Proceso de Asignación y Saludo de Apertura Finalizado ---")
-        return
+        return 0
 
     procesados_en_esta_ejecucion = 0
-    for ticket in tickets_para_procesar:
+    # Los que ya respondió fuera_horario se omiten: el índice de búsqueda puede
+    # seguir mostrándolos pendientes y sin agente aunque ya se estén cerrando.
+    ids_fuera_horario = fuera_horario.ids_respondidos_fuera_horario(archivos_estado_config, script_dir)
+    tickets_sin_agente = [ticket for ticket in tickets_para_procesar
+                          if not ticket.get('responder_id') and str(ticket['id']) not in ids_fuera_horario]
+    # Los más urgentes (SLA por vencer, prioridad, antigüedad) se asignan primero.
+    for ticket in prioridad_tickets.tickets_por_prioridad(tickets_sin_agente, max_tickets_por_ciclo, minutos_urgencia_sla):
         ticket_id_actual = ticket['id'] 
-        
-        if ticket.get('responder_id'): 
-            continue
 
         agente_id_seleccionado_str = _obtener_siguiente_agente_id_rotacion(agentes_operativos_cache, ruta_ultimo_agente)
         
@@ -150,7 +166,13 @@ def ejecutar_proceso_asignaciones(
 
         # Primero enviar respuesta, luego asignar y abrir.
         if _enviar_respuesta_fd(domain, api_key, ticket_id_actual, respuesta_formateada):
-            if _asignar_y_abrir_ticket_fd(domain, api_key, ticket_id_actual, agente_id_para_fd): 
+            latencias.registrar('saludo', ticket_id_actual, ticket.get('created_at'), agente_id_para_fd)
+            # Un ticket saludado y sin asignar se volvería a saludar en el próximo
+            # ciclo: la asignación se hace aunque se haya agotado el plazo de la etapa.
+            with freshdesk_api.sin_plazo():
+                asignado = _asignar_y_abrir_ticket_fd(domain, api_key, ticket_id_actual, agente_id_para_fd)
+            if asignado: 
+                latencias.registrar('asignacion', ticket_id_actual, ticket.get('created_at'), agente_id_para_fd)
                 print(f"Ticket #{ticket_id_actual} PROCESADO: Respuesta enviada, asignado a {nombre_del_agente_para_mensaje} (ID: {agente_id_para_fd}) y ABIERTO.")
                 procesados_en_esta_ejecucion += 1
             else:
@@ -160,4 +182,5 @@ def ejecutar_proceso_asignaciones(
 
     if procesados_en_esta_ejecucion > 0:
         print(f"Se procesaron {procesados_en_esta_ejecucion} asignaciones de tickets.")
-    print("--- Proceso de Asignación y Saludo de Apertura Finalizado ---")
\ No newline at end of file
+    print("--- Proceso de Asignación y Saludo de Apertura Finalizado ---")
+    return procesados_en_esta_ejecucion
\ No newline at end of file